@@ -4,9 +4,19 @@ from threading import Thread
 
 
 class AsyncTCPServer:
-    def __init__(self, port, new_connection_callback):
+    """
+    Serves TCP connections from a dedicated thread.
+
+    Connections are either handled with a streams API callback, or by
+    protocol instances created with the protocol factory.
+    """
+
+    def __init__(self, port, new_connection_callback=None, protocol_factory=None):
+        assert (new_connection_callback is None) != (protocol_factory is None)
+
         self._port = port
         self._new_connection_callback = new_connection_callback
+        self._protocol_factory = protocol_factory
 
     def start(self):
         backchannel = Queue()
@@ -25,12 +35,18 @@ class AsyncTCPServer:
         self._thread.join()
 
     async def _run(self, backchannel: Queue):
-        server = await asyncio.start_server(
-            self._new_connection_callback, host="0.0.0.0", port=self._port
-        )
+        loop = asyncio.get_running_loop()
+
+        if self._protocol_factory is None:
+            server = await asyncio.start_server(
+                self._new_connection_callback, host="0.0.0.0", port=self._port
+            )
+        else:
+            server = await loop.create_server(
+                self._protocol_factory, host="0.0.0.0", port=self._port
+            )
         asyncio.create_task(server.serve_forever())
 
-        loop = asyncio.get_running_loop()
         exit_event = asyncio.Event()
         backchannel.put((loop, exit_event))
 
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the exporter protocol codec.
+
+Measures the throughput of encoding, parsing and date-time formatting, per value type.
+The results are printed as JSON, e.g.
+
+    ./bench_codec.py --output codec.json
+
+To pin the throughput, compare a run against earlier results. The benchmark fails, if
+any case is slower than the baseline by more than the tolerance:
+
+    ./bench_codec.py --baseline codec.json --tolerance 0.2
+"""
+
+import sys
+import json
+import random
+import timeit
+import argparse
+import subprocess
+from time import time
+from typing import Optional
+from collections.abc import Callable
+from codec import (
+    encode_val,
+    encode_val_into,
+    encode_event,
+    parse_val,
+    epoch_as_text,
+)
+
+DOUBLE = "java.lang.Double"
+
+# number of distinct values, cycled through by the cases
+NUM_VALUES = 1024
+
+
+def _cycle(vals: list) -> Callable[[], object]:
+    """
+    Returns a function, that returns the values one by one, round robin.
+    """
+    index = 0
+
+    def next_val():
+        nonlocal index
+        index = (index + 1) % len(vals)
+        return vals[index]
+
+    return next_val
+
+
+def make_cases(rng: random.Random) -> dict[str, Callable[[], object]]:
+    """
+    Create the benchmarked cases, case name -> function to time.
+    """
+    # positions of a few motors, repeated as in READ polling and coalesced events
+    positions = [rng.uniform(-5.0, 5.0) for _ in range(16)]
+    # many distinct positions, as during a motor move
+    moving_positions = [rng.uniform(0.0, 360.0) for _ in range(NUM_VALUES)]
+    strings = [f"state{n}" for n in range(NUM_VALUES)]
+    ints = list(range(NUM_VALUES))
+    bools = [n % 2 == 0 for n in range(NUM_VALUES)]
+    lists = [[rng.uniform(-5.0, 5.0) for _ in range(6)] for _ in range(16)]
+    task_info = ["Start SCAN", "8", "2023-08-04 10:41:57.125", "", "", "", ""]
+    now = time()
+    # task start and end times, queried repeatedly by getTaskInfo polling
+    task_times = [now + n * 0.1 for n in range(16)]
+    distinct_times = [now + n * 1.001 for n in range(NUM_VALUES)]
+
+    position = _cycle(positions)
+    moving_position = _cycle(moving_positions)
+    string = _cycle(strings)
+    integer = _cycle(ints)
+    boolean = _cycle(bools)
+    lst = _cycle(lists)
+    task_time = _cycle(task_times)
+    distinct_time = _cycle(distinct_times)
+    float_text = _cycle([str(p) for p in moving_positions])
+    int_text = _cycle([str(n) for n in ints])
+    bool_text = _cycle(["true", "false", "True", "FALSE"])
+
+    def encode_into(val):
+        buf = bytearray()
+        encode_val_into(buf, val)
+        return buf
+
+    return {
+        "encode_str": lambda: encode_val(string()),
+        "encode_int": lambda: encode_val(integer()),
+        "encode_float_repeated": lambda: encode_val(position()),
+        "encode_float_distinct": lambda: encode_val(moving_position()),
+        "encode_bool": lambda: encode_val(boolean()),
+        "encode_none": lambda: encode_val(None),
+        "encode_float_list": lambda: encode_val(lst()),
+        "encode_str_list": lambda: encode_val(task_info),
+        "encode_into_float_repeated": lambda: encode_into(position()),
+        "encode_into_float_list": lambda: encode_into(lst()),
+        "encode_event_float": lambda: encode_event(
+            "OmegaPosition", moving_position(), 1700000000, DOUBLE
+        ),
+        "parse_int": lambda: parse_val(int, int_text()),
+        "parse_float": lambda: parse_val(float, float_text()),
+        "parse_bool": lambda: parse_val(bool, bool_text()),
+        "parse_str": lambda: parse_val(str, string()),
+        "epoch_as_text_repeated": lambda: epoch_as_text(task_time()),
+        "epoch_as_text_distinct": lambda: epoch_as_text(distinct_time()),
+    }
+
+
+def measure(func: Callable[[], object], number: int, repeat: int) -> float:
+    """
+    Returns the best throughput of the repeats, in operations per second.
+    """
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return number / best
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Returns descriptions of the cases, that are slower than the baseline beyond the tolerance.
+    """
+    regressions = []
+    for case, ops_per_sec in results["ops_per_sec"].items():
+        baseline_ops = baseline["ops_per_sec"].get(case)
+        if baseline_ops is None:
+            continue
+
+        if ops_per_sec < baseline_ops * (1 - tolerance):
+            regressions.append(
+                f"{case}: {ops_per_sec:.0f} ops/s, baseline {baseline_ops:.0f} ops/s"
+            )
+
+    return regressions
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MD3 exporter codec microbenchmarks")
+    parser.add_argument(
+        "--number", type=int, default=100000, help="operations per measurement"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="measurements per case, best is kept"
+    )
+    parser.add_argument(
+        "--output", help="write results to this file, instead of stdout"
+    )
+    parser.add_argument("--baseline", help="compare to results in this file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative throughput drop, compared to the baseline",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    cases = make_cases(random.Random(0))
+    results = {
+        "commit": get_commit(),
+        "parameters": {"number": args.number, "repeat": args.repeat},
+        "ops_per_sec": {
+            case: measure(func, args.number, args.repeat)
+            for case, func in cases.items()
+        },
+    }
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is None:
+        return
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+
+    if regressions:
+        print("throughput regressions:", file=sys.stderr)
+        for regression in regressions:
+            print(f"  {regression}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Multi-client load and latency benchmark for the MD3 exporter emulator.
+
+Starts the exporter in-process and drives a number of simulated MXCuBE-like clients
+against it. Each client mixes READ polling of motor positions, WRTE motor moves and
+EXEC startScanEx followed by getTaskInfo polling, while consuming all the events.
+
+Measures reply latencies, the rate of delivered events and the per-client event lag,
+that is the time from an attribute update in the emulator, until the client receives the event.
+
+The results are printed as JSON, e.g.
+
+    ./bench_exporter.py --clients 16 --duration 20 --output results.json
+"""
+
+import os
+
+# keep the exporter's stdout log out of the measurements, unless explicitly asked for
+os.environ.setdefault("MD3_LOG_LEVEL", "WARNING")
+
+import sys
+import json
+import random
+import asyncio
+import argparse
+import subprocess
+from time import perf_counter
+from typing import Optional
+from atcpserv import AsyncTCPServer
+from exporter import MD3Up, Exporter, Attribute, encode_val, STX, ETX
+
+BENCH_PORT = 19001
+
+# motors moved by the clients, and the range of target positions
+MOVED_MOTORS = {
+    "AlignmentY": (-1.0, 1.0),
+    "AlignmentZ": (-1.0, 1.0),
+    "CentringX": (-1.0, 1.0),
+    "CentringY": (-1.0, 1.0),
+    "Omega": (0.0, 360.0),
+}
+
+POLLED_ATTRIBUTES = [f"{motor}Position" for motor in MOVED_MOTORS] + [
+    "State",
+    "CurrentPhase",
+    "FastShutterIsOpen",
+]
+
+# relative weights of client actions
+ACTIONS = ["read", "move", "scan"]
+ACTION_WEIGHTS = [8, 1, 1]
+
+SCAN_EXPOSURE_TIME_SEC = 0.5
+
+
+def percentiles(samples: list[float]) -> dict:
+    """
+    Summarize samples with nearest-rank percentiles, in milliseconds.
+    """
+    if not samples:
+        return {"count": 0}
+
+    ordered = sorted(samples)
+
+    def percentile(p):
+        index = max(0, int(round(p / 100 * len(ordered))) - 1)
+        return ordered[index] * 1000
+
+    return {
+        "count": len(ordered),
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": ordered[-1] * 1000,
+    }
+
+
+class EventEmitTimes:
+    """
+    Keeps track of the times when events were emitted by the emulator.
+
+    Events are identified by their 'name, value and timestamp' text, as it is sent to the clients.
+    """
+
+    def __init__(self):
+        self._times: dict[str, float] = {}
+
+    def attribute_updated(self, name: str, attr: Attribute, timestamp: int):
+        self._times[f"{name}\t{encode_val(attr.val)}\t{timestamp}"] = perf_counter()
+
+    def get(self, event_key: str) -> Optional[float]:
+        return self._times.get(event_key)
+
+
+class BenchClient:
+    def __init__(
+        self, client_id: int, emit_times: EventEmitTimes, poll_interval: float
+    ):
+        self.client_id = client_id
+        self._emit_times = emit_times
+        self._poll_interval = poll_interval
+        self._rng = random.Random(client_id)
+
+        # (verb, send time, reply future) of requests waiting for a reply, in the order sent
+        self._pending: list[tuple[str, float, asyncio.Future]] = []
+
+        # verb -> reply latencies
+        self.latencies: dict[str, list[float]] = {}
+        self.events = 0
+        self.event_lags: list[float] = []
+
+    async def connect(self, port: int):
+        self._reader, self._writer = await asyncio.open_connection("127.0.0.1", port)
+        self._reader_task = asyncio.create_task(self._read_frames())
+
+    async def close(self):
+        self._writer.close()
+        self._reader_task.cancel()
+
+    async def _read_frames(self):
+        buffer = b""
+        while True:
+            data = await self._reader.read(64 * 1024)
+            if not data:
+                return
+            received = perf_counter()
+
+            buffer += data
+            *frames, buffer = buffer.split(ETX)
+            for frame in frames:
+                assert frame[0] == STX[0]
+                self._frame_received(frame[1:].decode(), received)
+
+    def _frame_received(self, frame: str, received: float):
+        if frame.startswith("EVT:"):
+            self.events += 1
+            # chop off the 'EVT:' prefix and the attribute type
+            event_key = frame[len("EVT:") :].rsplit("\t", 1)[0]
+            emitted = self._emit_times.get(event_key)
+            if emitted is not None:
+                self.event_lags.append(received - emitted)
+            return
+
+        verb, sent, reply = self._pending.pop(0)
+        self.latencies.setdefault(verb, []).append(received - sent)
+        reply.set_result(frame)
+
+    async def request(self, msg: str) -> str:
+        reply = asyncio.get_running_loop().create_future()
+        self._pending.append((msg[:4], perf_counter(), reply))
+        self._writer.write(STX + msg.encode() + ETX)
+
+        return await reply
+
+    async def _read(self):
+        await self.request(f"READ {self._rng.choice(POLLED_ATTRIBUTES)}")
+        await asyncio.sleep(self._poll_interval)
+
+    async def _move(self):
+        motor = self._rng.choice(list(MOVED_MOTORS))
+        position = self._rng.uniform(*MOVED_MOTORS[motor])
+        await self.request(f"WRTE {motor}Position {position}")
+
+    async def _scan(self):
+        start_angle = self._rng.uniform(0.0, 360.0)
+        reply = await self.request(
+            f"EXEC startScanEx 1\t{start_angle}\t10.0\t{SCAN_EXPOSURE_TIME_SEC}\t1"
+        )
+        task_id = reply[len("RET:") :]
+
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            task_info = await self.request(f"EXEC getTaskInfo {task_id}")
+            # the task's end time is filled in when it is finished
+            if task_info.split("\x1f")[4] != "":
+                return
+
+    async def run(self, deadline: float):
+        actions = {"read": self._read, "move": self._move, "scan": self._scan}
+
+        while perf_counter() < deadline:
+            action = self._rng.choices(ACTIONS, ACTION_WEIGHTS)[0]
+            await actions[action]()
+
+    def results(self) -> dict:
+        return {
+            "client": self.client_id,
+            "events": self.events,
+            "event_lag_ms": percentiles(self.event_lags),
+        }
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_clients(args, emit_times: EventEmitTimes) -> dict:
+    clients = [
+        BenchClient(client_id, emit_times, args.poll_interval)
+        for client_id in range(args.clients)
+    ]
+    for client in clients:
+        await client.connect(args.port)
+
+    # allow opening the fast shutter, regardless of the beamstop position
+    await clients[0].request("WRTE DirectBeamEnabled true")
+
+    start = perf_counter()
+    await asyncio.gather(*[client.run(start + args.duration) for client in clients])
+    elapsed = perf_counter() - start
+
+    for client in clients:
+        await client.close()
+
+    latencies = {}
+    for client in clients:
+        for verb, samples in client.latencies.items():
+            latencies.setdefault(verb, []).extend(samples)
+    all_latencies = [sample for samples in latencies.values() for sample in samples]
+    events = sum(client.events for client in clients)
+
+    return {
+        "commit": get_commit(),
+        "config": {
+            "clients": args.clients,
+            "duration_sec": args.duration,
+            "poll_interval_sec": args.poll_interval,
+        },
+        "elapsed_sec": elapsed,
+        "reply_latency_ms": {
+            "all": percentiles(all_latencies),
+            **{verb: percentiles(samples) for verb, samples in latencies.items()},
+        },
+        "events": {
+            "delivered": events,
+            "per_sec": events / elapsed,
+        },
+        "event_lag_ms": {
+            "all": percentiles([lag for c in clients for lag in c.event_lags]),
+            "clients": [client.results() for client in clients],
+        },
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MD3 exporter emulator benchmark")
+    parser.add_argument("--clients", type=int, default=8, help="number of clients")
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="benchmark duration in seconds"
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=0.02,
+        help="clients' delay between READ and getTaskInfo polls, in seconds",
+    )
+    parser.add_argument(
+        "--port", type=int, default=BENCH_PORT, help="exporter's TCP port"
+    )
+    parser.add_argument(
+        "--output", help="write results to this file, instead of stdout"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    md3 = MD3Up()
+    emit_times = EventEmitTimes()
+    md3.add_attribute_updated_callback(emit_times.attribute_updated)
+    exporter = Exporter(md3)
+
+    tcp_srv = AsyncTCPServer(args.port, protocol_factory=exporter.new_connection)
+    tcp_srv.start()
+    try:
+        results = asyncio.run(run_clients(args, emit_times))
+    finally:
+        tcp_srv.stop()
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
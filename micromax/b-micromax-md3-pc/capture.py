@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Recording and replaying of exporter protocol sessions.
+
+When capturing is enabled, the exporter records all messages of a client connection to
+a capture file. The file starts with the CAPTURE_MAGIC bytes, followed by a record per message:
+
+    direction    1 byte, b">" for messages from the client, b"<" for messages to the client
+    time         8 bytes, nanoseconds since the connection was opened
+    length       4 bytes, length of the message
+    message      the message, without STX and ETX framing bytes
+
+All integers are little-endian.
+
+Run this module as a script to replay a captured session against an exporter, e.g.
+
+    ./capture.py session.md3cap --speed 4
+
+The client messages are sent with the recorded timing, scaled by the speed factor, or as fast
+as possible with '--speed max'. The replies are compared to the recorded replies.
+"""
+
+import sys
+import math
+import struct
+import asyncio
+import argparse
+from time import monotonic_ns, perf_counter
+from pathlib import Path
+from datetime import datetime
+from dataclasses import dataclass
+from collections.abc import Iterator
+from codec import STX, ETX
+
+CAPTURE_MAGIC = b"MD3CAP1\n"
+CAPTURE_SUFFIX = ".md3cap"
+
+INBOUND = b">"
+OUTBOUND = b"<"
+
+RECORD_HEADER = struct.Struct("<cQI")
+
+
+@dataclass
+class Record:
+    direction: bytes
+    # nanoseconds since the connection was opened
+    time: int
+    message: bytes
+
+
+class CaptureWriter:
+    """
+    Records messages of one client connection to a capture file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, "wb")
+        self._file.write(CAPTURE_MAGIC)
+        self._start = monotonic_ns()
+
+    @staticmethod
+    def for_connection(capture_dir: str, peer: str) -> "CaptureWriter":
+        """
+        Create a capture file for a new connection, in the specified directory.
+        """
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S.%f")
+        peer = peer.replace(":", "_")
+        return CaptureWriter(Path(capture_dir, f"{timestamp}-{peer}{CAPTURE_SUFFIX}"))
+
+    def _record(self, direction: bytes, message: bytes | memoryview):
+        header = RECORD_HEADER.pack(
+            direction, monotonic_ns() - self._start, len(message)
+        )
+        self._file.write(header)
+        self._file.write(message)
+
+    def inbound(self, message: memoryview):
+        """
+        Record a message received from the client, without the framing bytes.
+        """
+        self._record(INBOUND, message)
+
+    def outbound(self, data: bytes):
+        """
+        Record the messages sent to the client, as one or more STX/ETX framed messages.
+
+        Each message is recorded separately, without the framing bytes.
+        """
+        with memoryview(data) as view:
+            start = 0
+            while start < len(data):
+                end = data.index(ETX, start)
+                # chop off STX and ETX bytes
+                self._record(OUTBOUND, view[start + 1 : end])
+                start = end + 1
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path: Path) -> Iterator[Record]:
+    with open(path, "rb") as f:
+        magic = f.read(len(CAPTURE_MAGIC))
+        if magic != CAPTURE_MAGIC:
+            raise ValueError(f"{path}: not a capture file")
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # end of file, or a truncated record, if exporter was killed while capturing
+                return
+
+            direction, time, length = RECORD_HEADER.unpack(header)
+            message = f.read(length)
+            if len(message) < length:
+                return
+
+            yield Record(direction, time, message)
+
+
+def is_reply(message: bytes) -> bool:
+    return not message.startswith(b"EVT:")
+
+
+class Replayer:
+    """
+    Replays the client messages of a captured session, and collects the replies.
+    """
+
+    def __init__(self, records: list[Record], speed: float):
+        self._requests = [r for r in records if r.direction == INBOUND]
+        self._speed = speed
+        self.num_requests = len(self._requests)
+
+        self.replies: list[bytes] = []
+        self._all_replied = asyncio.Event()
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        while len(self.replies) < len(self._requests):
+            try:
+                frame = await reader.readuntil(ETX)
+            except asyncio.IncompleteReadError:
+                # exporter closed the connection
+                break
+
+            # chop off STX and ETX bytes
+            message = frame[1:-1]
+            if is_reply(message):
+                self.replies.append(message)
+
+        self._all_replied.set()
+
+    async def run(self, host: str, port: int, reply_timeout: float) -> float:
+        """
+        Returns:
+            time it took to send all requests, in seconds
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        reader_task = asyncio.create_task(self._read_replies(reader))
+
+        start = perf_counter()
+        for request in self._requests:
+            if self._speed != math.inf:
+                delay = start + request.time / 1e9 / self._speed - perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            writer.write(STX + request.message + ETX)
+            await writer.drain()
+
+        elapsed = perf_counter() - start
+
+        try:
+            await asyncio.wait_for(self._all_replied.wait(), reply_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        reader_task.cancel()
+        writer.close()
+
+        return elapsed
+
+
+def diff_replies(records: list[Record], replies: list[bytes], max_diffs: int) -> int:
+    """
+    Print differences between recorded and replayed replies.
+
+    Returns:
+        number of differing replies
+    """
+    requests = [r.message for r in records if r.direction == INBOUND]
+    expected = [
+        r.message for r in records if r.direction == OUTBOUND and is_reply(r.message)
+    ]
+
+    diffs = 0
+    for n, request in enumerate(requests):
+        want = expected[n] if n < len(expected) else None
+        got = replies[n] if n < len(replies) else None
+        if want == got:
+            continue
+
+        diffs += 1
+        if diffs <= max_diffs:
+            print(f"#{n} {request!r}")
+            print(f"  recorded: {want!r}")
+            print(f"  replayed: {got!r}")
+
+    return diffs
+
+
+def parse_speed(speed: str) -> float:
+    if speed == "max":
+        return math.inf
+
+    return float(speed)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="replay captured exporter session")
+    parser.add_argument("capture", type=Path, help="capture file")
+    parser.add_argument("--host", default="localhost", help="exporter's host")
+    parser.add_argument("--port", type=int, default=9001, help="exporter's TCP port")
+    parser.add_argument(
+        "--speed",
+        type=parse_speed,
+        default=1.0,
+        help="replay speed factor, or 'max' for sending requests without delays",
+    )
+    parser.add_argument(
+        "--reply-timeout",
+        type=float,
+        default=5.0,
+        help="time to wait for outstanding replies, in seconds",
+    )
+    parser.add_argument(
+        "--max-diffs", type=int, default=20, help="max number of differences to print"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    records = list(read_capture(args.capture))
+    replayer = Replayer(records, args.speed)
+    elapsed = asyncio.run(replayer.run(args.host, args.port, args.reply_timeout))
+
+    diffs = diff_replies(records, replayer.replies, args.max_diffs)
+    print(
+        f"replayed {replayer.num_requests} requests in {elapsed:.3f} seconds, "
+        f"got {len(replayer.replies)} replies, {diffs} differing"
+    )
+
+    if diffs > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Encoding and parsing of exporter protocol values and messages.
+
+Values are encoded with table-driven dispatch on the value type. Float and date-time
+formatting are cached, as the same positions and task times are encoded over and over.
+
+Besides the str encoders, there are byte-level encoders that append straight into an
+output buffer, for building messages without intermediate strings:
+
+    buf = bytearray()
+    encode_event_into(buf, "OmegaPosition", 12.5, timestamp, DOUBLE)
+"""
+
+import math
+from datetime import datetime
+from functools import lru_cache
+from collections.abc import Callable
+
+STX = b"\02"
+ETX = b"\03"
+ARRAY_SEP = "\x1f"
+
+_EVT_PREFIX = STX + b"EVT:"
+
+# number of cached float and date-time encodings
+FLOAT_CACHE_SIZE = 4096
+EPOCH_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=FLOAT_CACHE_SIZE)
+def _encode_float_cached(val: float) -> str:
+    if math.isinf(val):
+        return "-Infinity" if val < 0 else "Infinity"
+
+    return str(val)
+
+
+def _encode_float(val: float) -> str:
+    if val == 0.0:
+        # 0.0 and -0.0 are equal, thus they would share a cache entry
+        return str(val)
+
+    return _encode_float_cached(val)
+
+
+def _encode_bool(val: bool) -> str:
+    return "true" if val else "false"
+
+
+def _encode_none(_val: None) -> str:
+    return "null"
+
+
+def _encode_str(val: str) -> str:
+    return val
+
+
+def _encode_list(val) -> str:
+    return ARRAY_SEP + ARRAY_SEP.join([encode_val(v) for v in val]) + ARRAY_SEP
+
+
+# value type -> encoder
+_ENCODERS: dict[type, Callable[[object], str]] = {
+    str: _encode_str,
+    int: str,
+    float: _encode_float,
+    bool: _encode_bool,
+    type(None): _encode_none,
+    list: _encode_list,
+    tuple: _encode_list,
+}
+
+
+def encode_val(val) -> str:
+    encoder = _ENCODERS.get(type(val))
+    assert encoder is not None, f"unsupported value type {type(val)}"
+
+    return encoder(val)
+
+
+@lru_cache(maxsize=FLOAT_CACHE_SIZE)
+def _encode_float_bytes_cached(val: float) -> bytes:
+    return _encode_float_cached(val).encode()
+
+
+def _encode_float_bytes(val: float) -> bytes:
+    if val == 0.0:
+        return str(val).encode()
+
+    return _encode_float_bytes_cached(val)
+
+
+def _encode_scalar_into(encode_bytes: Callable[[object], bytes]):
+    def encode_into(buf: bytearray, val):
+        buf += encode_bytes(val)
+
+    return encode_into
+
+
+# value type -> byte-level encoder
+_BYTES_ENCODERS: dict[type, Callable[[bytearray, object], None]] = {
+    str: _encode_scalar_into(str.encode),
+    int: _encode_scalar_into(lambda val: str(val).encode()),
+    float: _encode_scalar_into(_encode_float_bytes),
+    bool: _encode_scalar_into(lambda val: b"true" if val else b"false"),
+    type(None): _encode_scalar_into(lambda _val: b"null"),
+    # joining the elements' str encodings is faster than appending them one by one
+    list: _encode_scalar_into(lambda val: _encode_list(val).encode()),
+    tuple: _encode_scalar_into(lambda val: _encode_list(val).encode()),
+}
+
+
+def encode_val_into(buf: bytearray, val):
+    """
+    Append the encoded value to the buffer, same encoding as encode_val().
+    """
+    encoder = _BYTES_ENCODERS.get(type(val))
+    assert encoder is not None, f"unsupported value type {type(val)}"
+
+    encoder(buf, val)
+
+
+def encode_message(msg: str) -> bytes:
+    return STX + msg.encode() + ETX
+
+
+def encode_event_into(
+    buf: bytearray, attr_name: str, val, timestamp: int, attr_type: str
+):
+    """
+    Append an STX/ETX framed EVT message to the buffer.
+    """
+    buf += _EVT_PREFIX
+    buf += attr_name.encode()
+    buf += b"\t"
+    encode_val_into(buf, val)
+    buf += f"\t{timestamp}\t{attr_type}".encode()
+    buf += ETX
+
+
+def encode_event(attr_name: str, val, timestamp: int, attr_type: str) -> bytes:
+    buf = bytearray()
+    encode_event_into(buf, attr_name, val, timestamp, attr_type)
+
+    return bytes(buf)
+
+
+_BOOLS = {"true": True, "false": False}
+
+
+def parse_bool(val: str) -> bool:
+    parsed = _BOOLS.get(val.lower())
+    if parsed is None:
+        raise ValueError(f"unexpected boolean {val}")
+
+    return parsed
+
+
+def _parse_str(val: str) -> str:
+    return val
+
+
+# value type -> parser
+_PARSERS: dict[type, Callable[[str], object]] = {
+    int: int,
+    bool: parse_bool,
+    float: float,
+    str: _parse_str,
+}
+
+
+def parse_val(val_type, val):
+    parser = _PARSERS.get(val_type)
+    assert parser is not None, f"unsupported value type {val_type}"
+
+    return parser(val)
+
+
+@lru_cache(maxsize=EPOCH_CACHE_SIZE)
+def _format_second(seconds: int) -> str:
+    return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def epoch_as_text(epoch: float) -> str:
+    """
+    convert time in epoch seconds to textual date-time format, with milliseconds precision,
+    e.g '2023-12-12 15:44:15.695'
+    """
+    # split into whole seconds and microseconds, rounded the same way as datetime.fromtimestamp()
+    frac, seconds = math.modf(epoch)
+    microseconds = round(frac * 1e6)
+    if microseconds >= 1000000:
+        seconds += 1
+        microseconds -= 1000000
+    elif microseconds < 0:
+        seconds -= 1
+        microseconds += 1000000
+
+    # milliseconds are truncated, not rounded
+    return f"{_format_second(int(seconds))}.{microseconds // 1000:03d}"
@@ -0,0 +1,158 @@
+"""
+High-rate encoder samples of scans.
+
+During a scan, the real MD3 records the scanned motors' encoder positions at a high rate.
+Here the samples are computed from the scan's motor trajectories, into a buffer that is
+preallocated when the scan starts. The samples become readable as the scan progresses,
+i.e. a sample is available once the clock has passed its timestamp.
+
+The samples are read in pages, as rows of the sample time, followed by the axis positions.
+"""
+
+import math
+import numpy
+from time import time
+from typing import Optional
+from dataclasses import dataclass
+from collections import OrderedDict
+
+# column name of the sample times
+TIME_COLUMN = "Time"
+
+
+@dataclass
+class ScannedAxis:
+    name: str
+    start_pos: float
+    end_pos: float
+    # positions are wrapped modulo this value, for rotation axes
+    wrap: Optional[float] = None
+
+
+class EncoderBuffer:
+    """
+    Encoder samples of one scan.
+    """
+
+    def __init__(
+        self, axes: list[ScannedAxis], start_time: float, duration: float, rate: float
+    ):
+        """
+        Args:
+            start_time: time of the first sample, in unix epoch seconds
+            duration: scan duration in seconds
+            rate: samples per second
+        """
+        self.rate = rate
+        # samples after this time are not acquired, i.e. the scan was stopped
+        self._stop_time = math.inf
+        self.columns = [TIME_COLUMN] + [axis.name for axis in axes]
+
+        # the epsilon keeps a sample at the end time, despite floating point rounding
+        num_samples = int(duration * rate + 1e-6) + 1
+        # one row per sample, the time, followed by the axes positions
+        self._samples = numpy.empty((num_samples, len(self.columns)))
+
+        # seconds since the start of the scan
+        elapsed = numpy.arange(num_samples) / rate
+        numpy.add(elapsed, start_time, out=self._samples[:, 0])
+
+        for column, axis in enumerate(axes, start=1):
+            positions = self._samples[:, column]
+            if duration > 0:
+                velocity = (axis.end_pos - axis.start_pos) / duration
+                numpy.multiply(elapsed, velocity, out=positions)
+                positions += axis.start_pos
+            else:
+                positions.fill(axis.end_pos)
+
+            if axis.wrap is not None:
+                numpy.mod(positions, axis.wrap, out=positions)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def acquired(self) -> int:
+        """
+        Number of samples acquired so far.
+        """
+        now = min(time(), self._stop_time)
+        return int(numpy.searchsorted(self._samples[:, 0], now, side="right"))
+
+    def stop(self):
+        """
+        Stop acquiring samples, e.g. when the scan is aborted.
+        """
+        self._stop_time = min(time(), self._stop_time)
+
+    def read(self, offset: int, count: int) -> numpy.ndarray:
+        """
+        Read a page of the acquired samples.
+
+        Returns:
+            up to 'count' sample rows, starting at 'offset'
+        """
+        end = min(offset + count, self.acquired())
+        return self._samples[offset:end]
+
+
+class EncoderRecorder:
+    """
+    Keeps the encoder samples of the latest scans, by task ID.
+    """
+
+    def __init__(self, rate: float, max_buffers: int, max_samples: int):
+        """
+        Args:
+            rate: samples per second, 0 for not recording samples
+            max_buffers: number of latest scans, which samples are kept
+            max_samples: max number of samples of one scan, the rate of long
+                         scans is lowered to fit
+        """
+        self._rate = rate
+        self._max_buffers = max_buffers
+        self._max_samples = max_samples
+        # task ID -> samples, oldest first
+        self._buffers: OrderedDict[int, EncoderBuffer] = OrderedDict()
+
+    def allocate(
+        self, axes: list[ScannedAxis], start_time: float, duration: float
+    ) -> Optional[EncoderBuffer]:
+        """
+        Allocate the samples of a scan.
+
+        Args:
+            start_time: scan start, in unix epoch seconds
+
+        Returns:
+            the samples buffer, None if not recording samples
+        """
+        if self._rate <= 0:
+            return None
+
+        rate = self._rate
+        if duration * rate >= self._max_samples:
+            rate = (self._max_samples - 1) / duration
+
+        return EncoderBuffer(axes, start_time, duration, rate)
+
+    def add(self, task_id: int, samples: Optional[EncoderBuffer]):
+        """
+        Keep the samples allocated for a scan task.
+        """
+        if samples is None:
+            return
+
+        self._buffers[task_id] = samples
+        if len(self._buffers) > self._max_buffers:
+            self._buffers.popitem(last=False)
+
+    def stop_all(self):
+        for buffer in self._buffers.values():
+            buffer.stop()
+
+    def clear(self):
+        self._buffers.clear()
+
+    def get(self, task_id: int) -> Optional[EncoderBuffer]:
+        return self._buffers.get(task_id)
@@ -1,33 +1,108 @@
 #!/usr/bin/env python3
 from typing import Optional, Any
-from collections.abc import Callable
+from collections.abc import Awaitable, Callable, Coroutine, Iterable
 import asyncio
+import inspect
+import os
 import sys
+import json
 import math
+import atexit
 import traceback
-from time import time
-from asyncio import StreamReader, StreamWriter, Lock
-from datetime import datetime
+import itertools
+import threading
+from array import array
+from collections import deque
+from time import time, monotonic, perf_counter
 from atcpserv import AsyncTCPServer
+from capture import CaptureWriter
+from metrics import Registry, MetricsServer
+from profiler import Profiler, COMMAND, WRITE, CALLBACKS
+from motion import MotionEngine
+from encoder import EncoderBuffer, EncoderRecorder, ScannedAxis
+from raster import plan_raster_scan
+from latency import (
+    LatencyProfile,
+    load_latency_profile,
+    PHASE_CHANGE,
+    BEAMSTOP_TRAVEL,
+    MOTOR_MOVE,
+)
+from codec import (
+    STX,
+    ETX,
+    encode_val,
+    encode_message,
+    encode_event,
+    encode_event_into,
+    parse_bool,
+    parse_val,
+    epoch_as_text,
+)
 from dataclasses import dataclass, field
 
-MOTOR_STEPS = 8
+# rate of position events of moving motors, in Hz, 0 for only the final positions
+MOTION_EVENT_RATE = 4.0
+# time it takes to move motors, on an attribute write or startSimultaneousMoveMotors
+MOTOR_MOVE_TIME_SEC = 2.0
 PORT = 9001
-
-STX = b"\02"
-ETX = b"\03"
-ARRAY_SEP = "\x1f"
-
-READ = "READ "
-WRTE = "WRTE "
-LIST = "LIST"
-EXEC = "EXEC "
-NAME = "NAME"
+# max number of tasks kept in the task history
+TASK_HISTORY_SIZE = 1024
+# rate of the encoder samples recorded during scans, in Hz, 0 for not recording
+ENCODER_SAMPLE_RATE = 1000.0
+# number of latest scans, which encoder samples are kept
+ENCODER_BUFFERS = 4
+# max number of encoder samples of one scan, bounds the memory of the samples
+ENCODER_MAX_SAMPLES = 1000000
+# max number of encoder samples returned by one getEncoderSamples command
+ENCODER_PAGE_SIZE = 10000
+# HTTP port for the metrics endpoint
+METRICS_PORT = 9002
+# name of the snapshot of the MD3 state at the emulator start
+INITIAL_SNAPSHOT = "initial"
+
+# max number of EVT messages waiting to be sent to a client
+EVENT_QUEUE_SIZE = 256
+
+# log levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LOG_LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+# log categories
+TRAFFIC = "traffic"  # requests and replies
+EVENTS = "events"  # sent EVT messages
+ERRORS = "errors"  # invalid requests and error replies
+
+# max number of log messages waiting to be written
+LOG_BUFFER_SIZE = 16 * 1024
+LOG_FLUSH_INTERVAL_SEC = 0.05
+
+# separator of EXEC arguments, and of attribute names in a multi-attribute READ
+ARG_SEP = "\t"
+# READ and SUBS argument for all attributes
+ALL_ATTRIBUTES = "*"
+
+# message verbs
+READ = b"READ"
+WRTE = b"WRTE"
+LIST = b"LIST"
+EXEC = b"EXEC"
+NAME = b"NAME"
+# exporter extension, subscribe to events of specified attributes
+SUBS = b"SUBS"
+VERB_LEN = 4
 
 BEAMSTOP_TRAVEL_TIME_SEC = 2.6
 # supported predefined beamstop positions
 BEAMSTOP_POSITIONS = ["PARK", "BEAM", "TRANSFER", "OFF"]
 
+# time it takes to move from the end of a raster scan line, to the start of the next line
+RASTER_LINE_TRANSITION_TIME_SEC = 0.1
+
 PHASE_CHANGE_TIME_SEC = 3.1
 # supported MD3 phases
 PHASES = ["Centring", "BeamLocation", "DataCollection", "Transfer"]
@@ -59,6 +134,32 @@ INITIAL_EVENTS = [
 ]
 
 
+def _initial_event_attributes():
+    """
+    Attributes of the events sent to a newly connected client, in the order MD3 sends them.
+
+    Yields (attribute name, event name) pairs.
+    """
+    yield "State", "State"
+    yield "Status", "Status"
+
+    for name in INITIAL_EVENTS:
+        state = f"{name}State"
+        position = f"{name}Position"
+        yield state, state
+        yield position, state
+
+    yield "DetectorState", "DetectorState"
+    yield "DetectorDistance", "DetectorState"
+
+    # MD3 sends CurrentApertureDiameterIndex event twice for some reason
+    yield "CurrentApertureDiameterIndex", "CurrentApertureDiameterIndex"
+    yield "CurrentApertureDiameterIndex", "CurrentApertureDiameterIndex"
+
+
+INITIAL_EVENT_ATTRIBUTES = list(_initial_event_attributes())
+
+
 @dataclass
 class CoaxCamScale:
     x: float
@@ -83,15 +184,25 @@ COAX_CAM_SCALES = [
 ]
 
 
-@dataclass
 class Attribute:
-    _val: Any
-    type: str
+    __slots__ = ("name", "_val", "type", "value_transform", "version")
+
+    def __init__(
+        self,
+        val: Any,
+        type: str,
+        value_transform: Optional[Callable[[Any], Any]] = None,
+    ):
+        # set when the attribute is added to an AttributeStore
+        self.name = ""
+        self._val = val
+        self.type = type
+
+        # This callback function is meant to provide a way to validate and/or modify the new value before it's set.
+        self.value_transform = value_transform
 
-    # This callback function is meant to provide a way to validate and/or modify the new value before it's set.
-    value_transform: Callable[[Any], Any] = field(
-        default=lambda val: val
-    )  # identity function by default
+        # Incremented on each value update, allows to cache data derived from the value.
+        self.version = 0
 
     @property
     def val(self):
@@ -99,7 +210,88 @@ class Attribute:
 
     @val.setter
     def val(self, val: Any):
-        self._val = self.value_transform(val)
+        if self.value_transform is not None:
+            val = self.value_transform(val)
+        self.assign(val)
+
+    def assign(self, val: Any):
+        """
+        Set the value, without the value transform.
+        """
+        self._val = val
+        self.version += 1
+
+
+class DoubleAttribute(Attribute):
+    """
+    An attribute of double type, which value is kept in the attribute store's array of doubles.
+    """
+
+    __slots__ = ("_values", "_index")
+
+    def __init__(self, values: array, index: int, attr: Attribute):
+        super().__init__(None, attr.type, attr.value_transform)
+        self._values = values
+        self._index = index
+
+    @property
+    def val(self):
+        return self._values[self._index]
+
+    @val.setter
+    def val(self, val: Any):
+        if self.value_transform is not None:
+            val = self.value_transform(val)
+        self.assign(val)
+
+    def assign(self, val: Any):
+        self._values[self._index] = val
+        self.version += 1
+
+
+class AttributeStore:
+    """
+    Attributes, by interned attribute name.
+
+    The values of double attributes are kept in one contiguous array.
+    """
+
+    def __init__(self, attrs: dict[str, Attribute]):
+        self._doubles = array("d")
+        self._attrs: dict[str, Attribute] = {}
+
+        for name, attr in attrs.items():
+            if attr.type == DOUBLE:
+                index = len(self._doubles)
+                self._doubles.append(attr.val)
+                attr = DoubleAttribute(self._doubles, index, attr)
+
+            attr.name = sys.intern(name)
+            self._attrs[attr.name] = attr
+
+    def __getitem__(self, name: str) -> Attribute:
+        return self._attrs[name]
+
+    def get(self, name: str) -> Optional[Attribute]:
+        return self._attrs.get(name)
+
+    def items(self):
+        return self._attrs.items()
+
+
+class MotorHandle:
+    """
+    Precomputed attributes of a motor, so that moving motors are updated without
+    formatting or looking up the attribute names.
+    """
+
+    __slots__ = ("name", "position", "state", "wrap")
+
+    def __init__(self, name: str, attrs: AttributeStore):
+        self.name = name
+        self.position = attrs[f"{name}Position"]
+        self.state = attrs[f"{name}State"]
+        self.wrap = _motor_wrap(name)
 
 
 @dataclass
@@ -108,9 +300,128 @@ class Task:
     # times are in unix epoch seconds
     start_time: float
     end_time: float
+    # set by the emulator, when the task finishes
+    finished: bool = False
+    # set when the task is stopped by the abort command
+    aborted: bool = False
+    # set when the task finishes, created on demand for tasks that are waited for
+    done: Optional[asyncio.Event] = field(default=None, compare=False)
+    # finishes the task, when it's running time is over, None for tasks
+    # that are finished by their coroutine
+    timer: Optional[asyncio.TimerHandle] = field(default=None, compare=False)
 
     def is_running(self) -> bool:
-        return self.end_time > time()
+        return not self.finished
+
+    def info(self, flags: str = "8") -> list[str]:
+        """
+        The task info, as returned by getTaskInfo command.
+        """
+        if self.is_running():
+            end_time, result, exception, result_id = "", "", "", ""
+        elif self.aborted:
+            end_time, result, exception, result_id = (
+                epoch_as_text(self.end_time),
+                "false",
+                "Task aborted",
+                "1",
+            )
+        else:
+            # finished, aka not running
+            end_time, result, exception, result_id = (
+                epoch_as_text(self.end_time),
+                "true",
+                "null",
+                "1",
+            )
+
+        return [
+            self.name,
+            flags,
+            epoch_as_text(self.start_time),
+            end_time,
+            result,
+            exception,
+            result_id,
+        ]
+
+
+class TaskStore:
+    """
+    Bounded history of tasks, indexed by task ID.
+
+    When the history is full, the finished tasks are evicted in the order they finished.
+    Running tasks are never evicted, thus the history may grow beyond its size while
+    many tasks are running, and it shrinks back as the tasks finish.
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._last_id = 0
+        # task ID -> task, in the order the tasks were started
+        self._tasks: dict[int, Task] = {}
+        # task ID -> running task
+        self._running: dict[int, Task] = {}
+        # IDs of finished tasks, in the order they finished
+        self._finished: deque[int] = deque()
+
+    def add(self, task: Task) -> int:
+        self._last_id += 1
+        task_id = self._last_id
+
+        self._tasks[task_id] = task
+        self._running[task_id] = task
+        self._evict()
+
+        return task_id
+
+    def finish(self, task_id: int) -> Task:
+        """
+        Mark a running task as finished.
+        """
+        task = self._running.pop(task_id)
+        task.finished = True
+        self._finished.append(task_id)
+        self._evict()
+
+        return task
+
+    def _evict(self):
+        while len(self._tasks) > self._max_size and self._finished:
+            del self._tasks[self._finished.popleft()]
+
+    def get(self, task_id: int) -> Optional[Task]:
+        return self._tasks.get(task_id)
+
+    def running(self) -> list[int]:
+        """
+        IDs of the running tasks.
+        """
+        return list(self._running)
+
+    def snapshot(self) -> dict:
+        return {
+            "last_id": self._last_id,
+            "tasks": [
+                [task_id, task.name, task.start_time, task.end_time, task.aborted]
+                for task_id, task in self._tasks.items()
+            ],
+        }
+
+    def restore(self, snapshot: dict):
+        """
+        Replace the tasks with the snapshot's tasks, all restored tasks are finished.
+        """
+        self._last_id = snapshot["last_id"]
+        self._tasks.clear()
+        self._running.clear()
+        self._finished.clear()
+
+        for task_id, name, start_time, end_time, aborted in snapshot["tasks"]:
+            self._tasks[task_id] = Task(
+                name, start_time, end_time, finished=True, aborted=aborted
+            )
+            self._finished.append(task_id)
 
 
 @dataclass
@@ -139,81 +450,176 @@ class DisallowedState(Exception):
     """Exception for cases where a command or attribute is invoked, although it is not allowed in the current state."""
 
 
-def log(msg: str):
-    print(msg)
-    sys.stdout.flush()
+class Log:
+    """
+    Writes log messages to stdout from a background thread, so that logging never blocks the event loop.
+
+    Messages are passed to the writer thread via a ring buffer. If the writer thread falls
+    behind, the oldest messages are dropped.
+
+    The 'traffic', 'events' and 'errors' flags are set when messages of that category
+    are enabled. Check them before formatting a message, so that disabled logging costs nothing:
+
+        if log.traffic:
+            log.debug(f"> {data}")
+    """
+
+    def __init__(self, level: int, categories: set[str]):
+        self._level = level
+
+        # traffic and events are logged at debug level
+        self.traffic = TRAFFIC in categories and level <= DEBUG
+        self.events = EVENTS in categories and level <= DEBUG
+        self.errors = ERRORS in categories and level <= WARNING
+
+        # (sequence number, message) entries, sequence numbers are used for detecting dropped messages
+        self._buffer: deque[tuple[int, str]] = deque(maxlen=LOG_BUFFER_SIZE)
+        self._sequence = itertools.count()
+        self._last_written = -1
+
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def from_env() -> "Log":
+        """
+        Create log, configured by MD3_LOG_LEVEL and MD3_LOG_CATEGORIES environment variables.
+        """
+        level = os.environ.get("MD3_LOG_LEVEL", "DEBUG")
+        categories = os.environ.get(
+            "MD3_LOG_CATEGORIES", f"{TRAFFIC},{EVENTS},{ERRORS}"
+        )
+
+        return Log(
+            LOG_LEVELS[level.upper()],
+            {category.strip() for category in categories.split(",")},
+        )
+
+    def _log(self, level: int, msg: str):
+        if level < self._level:
+            return
 
+        # deque appends are thread-safe, thus no locking is needed here
+        self._buffer.append((next(self._sequence), msg))
 
-def encode_val(val) -> str:
-    def encode_list():
-        str_lst = [encode_val(v) for v in val]
-        return ARRAY_SEP + ARRAY_SEP.join(str_lst) + ARRAY_SEP
+        if level >= ERROR:
+            self._wakeup.set()
 
-    def encode_float():
-        if math.isinf(val):
-            txt = "Infinity"
-            if val < 0:
-                txt = "-" + txt
-            return txt
+    def debug(self, msg: str):
+        self._log(DEBUG, msg)
 
-        return str(val)
+    def info(self, msg: str):
+        self._log(INFO, msg)
 
-    val_type = type(val)
+    def warning(self, msg: str):
+        self._log(WARNING, f"WARNING: {msg}")
 
-    if val_type == str:
-        return val
+    def error(self, msg: str):
+        self._log(ERROR, f"ERROR: {msg}")
 
-    if val_type == int:
-        return str(val)
+    def exception(self, ex: Exception):
+        self.error("".join(traceback.format_exception(ex)))
 
-    if val_type == float:
-        return encode_float()
+    def flush(self):
+        """
+        Write all buffered messages to stdout.
+        """
+        with self._flush_lock:
+            lines = []
+            while self._buffer:
+                sequence, msg = self._buffer.popleft()
+                dropped = sequence - self._last_written - 1
+                if dropped > 0:
+                    lines.append(
+                        f"WARNING: log buffer full, dropped {dropped} messages"
+                    )
+                self._last_written = sequence
+                lines.append(msg)
 
-    if val_type in (list, tuple):
-        return encode_list()
+            if not lines:
+                return
 
-    if val_type == bool:
-        return "true" if val else "false"
+            lines.append("")
+            sys.stdout.write("\n".join(lines))
+            sys.stdout.flush()
 
-    if val_type == type(None):
-        return "null"
+    def _flush_periodically(self):
+        while True:
+            self._wakeup.wait(LOG_FLUSH_INTERVAL_SEC)
+            self._wakeup.clear()
+            self.flush()
 
-    assert False, f"unsupported value type {val_type}"
 
+log = Log.from_env()
+profiler = Profiler.from_env()
 
-def parse_val(val_type, val):
-    def parse_bool(val: str) -> bool:
-        val = val.lower()
-        if val == "true":
-            return True
-        if val == "false":
-            return False
 
-        assert False, f"unexpected boolean {val}"
+# parsers for command argument types, arguments of other types are passed as strings
+ARG_PARSERS = {
+    "double": float,
+    "int": int,
+    "long": int,
+    "boolean": parse_bool,
+}
 
-    if val_type == int:
-        return int(val)
 
-    if val_type == bool:
-        return parse_bool(val)
+CommandArgsParser = Callable[[list[str]], list]
 
-    if val_type == float:
-        return float(val)
 
-    if val_type == str:
-        return val
+def compile_args_parser(command_name: str, args_signature: str) -> CommandArgsParser:
+    """
+    Create a parser for command arguments with the specified signature.
+
+    Args:
+        args_signature: Java style argument types, e.g. "int, double, boolean"
+
+    Returns:
+        function that converts a list of textual arguments to the values of signature types,
+        raises CommandError on a wrong number of arguments or a malformed argument
+    """
+    parsers = [
+        ARG_PARSERS.get(arg_type.strip(), str)
+        for arg_type in args_signature.split(",")
+        if arg_type.strip() != ""
+    ]
+    num_args = len(parsers)
+    # MD3 error message when command is called with wrong arguments
+    error_msg = f"No method with the correct signature: true.{command_name}"
+
+    def parse_args(args: list[str]) -> list:
+        if len(args) != num_args:
+            raise CommandError(error_msg)
+
+        try:
+            return [parse(arg) for parse, arg in zip(parsers, args)]
+        except ValueError:
+            raise CommandError(error_msg)
+
+    return parse_args
+
 
-    assert False, f"unsupported value type {val_type}"
+def _check_exposure_time(command_name: str, exposure_time: float):
+    if exposure_time < 0:
+        # MD3 error message when command is called with wrong arguments
+        raise CommandError(f"No method with the correct signature: true.{command_name}")
 
 
-def epoch_as_text(epoch: float) -> str:
+# field types of snapshot's task rows, i.e. ID, name, start and end time, aborted
+_SNAPSHOT_TASK_TYPES = [
+    [int, str, start_type, end_type, bool]
+    for start_type in (int, float)
+    for end_type in (int, float)
+]
+
+
+def _motor_wrap(motor_name: str) -> Optional[float]:
     """
-    convert time in epoch seconds to textual date-time format
+    Omega is a rotation angle motor, thus a special case.
+    MD3 automatically wraps any set value within 0..360 degrees range.
     """
-    txt = datetime.fromtimestamp(epoch).strftime("%Y-%m-%d %H:%M:%S.%f")
-    # cut of last 3 digit, so that seconds are returned with milliseconds precision,
-    # e.g '2023-12-12 15:44:15.695130' becomes '2023-12-12 15:44:15.695'
-    return txt[:-3]
+    return 360.0 if motor_name == "Omega" else None
 
 
 def _wrap_omega_position(new_omega_position: float) -> float:
@@ -221,22 +627,282 @@ def _wrap_omega_position(new_omega_position: float) -> float:
     return new_omega_position % 360.0
 
 
-class SynchronizedWriter:
-    def __init__(self, writer: StreamWriter):
-        self._writer = writer
-        self._lock = Lock()
+class TransportWriter:
+    """
+    Writes to a client connection transport, and keeps track of the transport's flow control.
+    """
+
+    def __init__(
+        self, transport: asyncio.WriteTransport, capture: Optional[CaptureWriter]
+    ):
+        self._transport = transport
+        # records the connection's messages, when capturing is enabled
+        self.capture = capture
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def write(self, data: bytes):
+        self._transport.write(data)
+
+    def pause(self):
+        self._writable.clear()
+
+    def resume(self):
+        self._writable.set()
+
+    async def wait_writable(self):
+        """
+        Wait until the transport's write buffer is drained below the high-water mark.
+        """
+        await self._writable.wait()
+
+
+class EventQueue:
+    """
+    Bounded queue of EVT messages waiting to be sent to a client.
+
+    While an event for an attribute is still waiting in the queue, a new coalesced
+    event for the same attribute replaces it. This way a client that falls behind
+    only gets the latest position or state values.
+
+    When the queue is full, the oldest waiting event is dropped.
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        # waiting messages, in the order they were put into the queue,
+        # coalesced messages are keyed by the attribute name
+        self._msgs: dict[str | int, bytes] = {}
+        self._msg_counter = 0
+        self._not_empty = asyncio.Event()
+
+    def put(self, attr_name: str, msg: bytes, coalesce: bool):
+        if coalesce:
+            key = attr_name
+            # drop superseded message, if any
+            self._msgs.pop(key, None)
+        else:
+            self._msg_counter += 1
+            key = self._msg_counter
+
+        self._msgs[key] = msg
+
+        if len(self._msgs) > self._max_size:
+            oldest = next(iter(self._msgs))
+            del self._msgs[oldest]
+            if log.errors:
+                log.warning(f"event queue full, dropped event {oldest}")
+
+        self._not_empty.set()
+
+    def __len__(self):
+        return len(self._msgs)
+
+    async def get_all(self) -> list[bytes]:
+        """
+        Wait until there are waiting messages, and remove all of them from the queue.
+        """
+        await self._not_empty.wait()
+
+        msgs = list(self._msgs.values())
+        self._msgs.clear()
+        self._not_empty.clear()
+
+        return msgs
+
+
+@dataclass
+class EventFilterConfig:
+    # changes of numeric values, smaller than the deadbands, are not emitted
+    abs_deadband: float = 0.0
+    # deadband relative to the last emitted value, e.g. 0.01 for 1%
+    rel_deadband: float = 0.0
+    # max number of events per second, None for no limit
+    max_rate: Optional[float] = None
+    # a value within the deadband is emitted, once the attribute has not been
+    # updated for this many seconds
+    settle_time: float = 0.5
+
+
+def load_event_filters(path: Optional[str]) -> dict[str, EventFilterConfig]:
+    """
+    Load event filters configuration from a JSON file.
+
+    The file maps attribute names or attribute types to the filter parameters, e.g.
+
+        {
+            "java.lang.Double": {"abs_deadband": 0.0001, "max_rate": 20},
+            "OmegaPosition": {"abs_deadband": 0.01, "max_rate": 10}
+        }
+
+    Filters for attribute names take precedence over filters for attribute types.
+    """
+    if path is None:
+        return {}
+
+    with open(path) as f:
+        return {
+            key: EventFilterConfig(**params) for key, params in json.load(f).items()
+        }
+
+
+class EventFilter:
+    """
+    Decides which attribute updates are emitted as events.
+
+    Updates are suppressed if a numeric value changes by less than the configured deadband,
+    or if an event for the attribute was emitted too recently, according to the max rate.
+
+    When an update is suppressed, a trailing event is scheduled. Rate limited values are
+    emitted as soon as the rate allows it, values within the deadband once the attribute
+    has settled, i.e. not been updated for a while. Thus the final value of an attribute
+    is always emitted.
+    """
+
+    def __init__(
+        self,
+        configs: dict[str, EventFilterConfig],
+        trailing_event_callback: Callable[[str], None],
+    ):
+        self._configs = configs
+        self._trailing_event_callback = trailing_event_callback
+
+        # attribute name -> (last emitted value, emit time)
+        self._emitted: dict[str, tuple[Any, float]] = {}
+        # attribute name -> last update time
+        self._updated: dict[str, float] = {}
+        # attribute name -> scheduled trailing event
+        self._trailing: dict[str, asyncio.TimerHandle] = {}
+
+    def _get_config(
+        self, attr_name: str, attr: Attribute
+    ) -> Optional[EventFilterConfig]:
+        config = self._configs.get(attr_name)
+        if config is None:
+            config = self._configs.get(attr.type)
+
+        return config
+
+    def _in_deadband(self, config: EventFilterConfig, val, last_val) -> bool:
+        if type(val) not in (int, float) or type(last_val) not in (int, float):
+            return False
+
+        deadband = max(config.abs_deadband, config.rel_deadband * abs(last_val))
+
+        return abs(val - last_val) < deadband
+
+    def _schedule_trailing_event(
+        self, delay: float, attr_name: str, attr: Attribute, config: EventFilterConfig
+    ):
+        self._trailing[attr_name] = asyncio.get_running_loop().call_later(
+            delay, self._send_trailing_event, attr_name, attr, config
+        )
+
+    def accept(self, attr_name: str, attr: Attribute) -> bool:
+        config = self._get_config(attr_name, attr)
+        if config is None:
+            return True
+
+        now = monotonic()
+        self._updated[attr_name] = now
+
+        emitted = self._emitted.get(attr_name)
+        if emitted is None:
+            self.emitted(attr_name, attr.val)
+            return True
+
+        last_val, last_time = emitted
+        next_time = now
+        if config.max_rate is not None:
+            next_time = last_time + 1 / config.max_rate
+
+        in_deadband = self._in_deadband(config, attr.val, last_val)
+        if next_time <= now and not in_deadband:
+            self.emitted(attr_name, attr.val)
+            return True
+
+        if attr_name not in self._trailing:
+            delay = config.settle_time if in_deadband else next_time - now
+            self._schedule_trailing_event(delay, attr_name, attr, config)
+
+        return False
+
+    def flush(self, attr_name: str):
+        """
+        Send the attribute's withheld value right away, if there is one.
+        """
+        trailing = self._trailing.pop(attr_name, None)
+        if trailing is None:
+            return
+
+        trailing.cancel()
+        self._trailing_event_callback(attr_name)
+
+    def emitted(self, attr_name: str, val):
+        """
+        Take a note that an event with the specified value was emitted.
+        """
+        self._emitted[attr_name] = (val, monotonic())
+
+        trailing = self._trailing.pop(attr_name, None)
+        if trailing is not None:
+            trailing.cancel()
+
+    def _send_trailing_event(
+        self, attr_name: str, attr: Attribute, config: EventFilterConfig
+    ):
+        del self._trailing[attr_name]
+
+        last_val, _ = self._emitted[attr_name]
+        if attr.val == last_val:
+            return
+
+        if self._in_deadband(config, attr.val, last_val):
+            # a small change, wait until the attribute has settled
+            settled = self._updated[attr_name] + config.settle_time
+            now = monotonic()
+            if settled > now:
+                self._schedule_trailing_event(settled - now, attr_name, attr, config)
+                return
 
-    async def write_drain(self, msg):
-        async with self._lock:
-            self._writer.write(msg)
-            await self._writer.drain()
+        self._trailing_event_callback(attr_name)
 
 
 class MD3Up:
-    def __init__(self):
-        self._attr_updated_callbacks: set[AttributeUpdatedCallback] = set()
-        self._synchronization_id = 0
-        self._tasks = {}
+    def __init__(
+        self,
+        motion_event_rate: float = MOTION_EVENT_RATE,
+        task_history_size: int = TASK_HISTORY_SIZE,
+        encoder_sample_rate: float = ENCODER_SAMPLE_RATE,
+        latency: Optional[LatencyProfile] = None,
+    ):
+        """
+        Args:
+            latency: if specified, emulated durations are sampled from this profile
+        """
+        self._latency = latency
+        # attribute name -> callbacks subscribed to updates of the attribute
+        self._attr_updated_callbacks: dict[str, set[AttributeUpdatedCallback]] = {}
+        # callbacks subscribed to updates of all attributes
+        self._all_attrs_updated_callbacks: set[AttributeUpdatedCallback] = set()
+        # callback -> subscribed attribute names, or None if subscribed to all attributes
+        self._callback_subscriptions: dict[
+            AttributeUpdatedCallback, Optional[frozenset[str]]
+        ] = {}
+        self._tasks = TaskStore(task_history_size)
+        self._num_running_tasks = 0
+        # asyncio tasks, running the emulated MD3 tasks and moves
+        self._coroutines: set[asyncio.Task] = set()
+        # the latest beamstop move, it's in-flight while in the running coroutines
+        self._beamstop_move: Optional[asyncio.Task] = None
+        self._encoder = EncoderRecorder(
+            encoder_sample_rate, ENCODER_BUFFERS, ENCODER_MAX_SAMPLES
+        )
+        self._motion = MotionEngine(
+            1 / motion_event_rate if motion_event_rate > 0 else None,
+            self._motor_position_updated,
+            self._motor_stopped,
+        )
 
         self._motors = {
             # name: (limits)
@@ -248,8 +914,7 @@ class MD3Up:
             "CentringY": (-3.05, 3.5),
             "CentringTableFocus": (-3.19668, 3.19871),
         }
-
-        self._attrs = {
+        attrs = {
             # note: the AlignmentTablePosition type signature is a guess
             "AlignmentTablePosition": Attribute(
                 "TRANSFER", "org.embl.md.dev.AlignmentTable$Position"
@@ -316,16 +981,9 @@ class MD3Up:
             "HeadType": Attribute(
                 "SmartMagnet", "org.embl.md.RemoteInterface$HeadType"
             ),
+            # MD3 reports a 'Hot Start' task after starting up
             "LastTaskInfo": Attribute(
-                [
-                    "Hot Start",
-                    "0",
-                    "2023-08-04 10:41:57.125",
-                    "2023-08-04 10:41:57.325",
-                    "true",
-                    "null",
-                    "1",
-                ],
+                Task("Hot Start", time() - 0.2, time(), finished=True).info(flags="0"),
                 "TODO",
             ),
             "OmegaPosition": Attribute(359.999979169585, DOUBLE),
@@ -354,6 +1012,19 @@ class MD3Up:
             "ZoomPosition": Attribute(0.0, DOUBLE),
             "ZoomState": Attribute("Ready", STATE),
         }
+        self._attrs = AttributeStore(attrs)
+
+        self._motor_handles = {
+            name: MotorHandle(name, self._attrs) for name in self._motors
+        }
+        # motor position attribute name -> motor
+        self._motor_position_attrs = {
+            handle.position.name: handle for handle in self._motor_handles.values()
+        }
+        # motor state attribute name -> motor
+        self._motor_state_attrs = {
+            handle.state.name: handle for handle in self._motor_handles.values()
+        }
 
         self._commands = {
             # double[] getMotorLimits(String)
@@ -421,19 +1092,23 @@ class MD3Up:
             ),
         }
 
+        self._command_args_parsers = {
+            name: compile_args_parser(name, args_signature)
+            for name, (_, args_signature, _) in self._commands.items()
+        }
+
         # add an internal attributes watcher, to deal with zoom changes
-        self.add_attribute_updated_callback(self._attribute_updated)
+        self.add_attribute_updated_callback(
+            self._attribute_updated, ["CoaxialCameraZoomValue"]
+        )
 
     def _attribute_updated(self, name: str, attr: Any, timestamp: int):
         """
         This callback watches for zoom level changes and updates camera scale attributes.
-        """
-        if name != "CoaxialCameraZoomValue":
-            # we only care about CoaxialCameraZoomValue, aka zoom level changes
-            return
 
+        It is only subscribed to CoaxialCameraZoomValue attribute updates.
+        """
         #
-        # Here we know that it's the CoaxialCameraZoomValue attribute changed.
         # Update the CoaxCamScale attributes to match new zoom level.
         #
 
@@ -484,86 +1159,368 @@ class MD3Up:
 
         return new_position
 
-    def _add_task(self, name: str, running_time: float):
-        def get_synchronization_id():
-            self._synchronization_id += 1
-            return self._synchronization_id
-
-        task_id = get_synchronization_id()
+    def _add_task(self, name: str, running_time: Optional[float]):
+        """
+        Args:
+            running_time: the task is finished after this many seconds,
+                          None if the caller finishes the task
+        """
         now = time()
-        self._tasks[task_id] = Task(name, now, now + running_time)
+        task = Task(name, now, now if running_time is None else now + running_time)
+        task_id = self._tasks.add(task)
+
+        self._num_running_tasks += 1
+        if self._num_running_tasks == 1:
+            self.write_attribute("State", "Running")
+
+        if running_time is not None:
+            task.timer = asyncio.get_running_loop().call_later(
+                running_time, self._task_finished, task_id
+            )
 
         return task_id
 
-    def _get_task(self, task_id: str) -> Task:
-        task_id = int(task_id)
+    def _start_task(self, name: str, coro: Coroutine) -> int:
+        """
+        Start a task, that runs until the coroutine is done.
+        """
+        task_id = self._add_task(name, None)
         task = self._tasks.get(task_id)
-        if task is None:
-            raise CommandError(f"Invalid task: {task_id}")
 
-        return task
+        def coroutine_done(_coroutine: asyncio.Task):
+            # an aborted task is already finished
+            if not task.finished:
+                self._task_finished(task_id)
 
-    def _do_get_motor_limits(self, motor_name) -> tuple[float, float]:
-        return self._motors[motor_name]
+        self._start_coroutine(coro).add_done_callback(coroutine_done)
 
-    def _do_start_set_phase(self, phase) -> int:
-        async def update_current_phase():
-            self.write_attribute("CurrentPhase", "Unknown")
-            await asyncio.sleep(PHASE_CHANGE_TIME_SEC)
-            self.write_attribute("CurrentPhase", phase)
-            if phase == "DataCollection":
-                self.write_attribute("BeamstopPosition", "BEAM")
+        return task_id
 
-        if phase not in PHASES:
-            # MD3 error message when unexpected phase specified
-            raise CommandError(
-                "No method with the correct signature: true.startSetPhase"
-            )
+    def _duration(self, name: str, default: float) -> float:
+        if self._latency is None:
+            return default
 
-        asyncio.create_task(update_current_phase())
-        return self._add_task(f"Set {phase.upper()} PHASE", PHASE_CHANGE_TIME_SEC + 0.1)
+        return self._latency.duration(name, default)
 
-    def _do_start_raster_scan(
-        self,
-        _vertical_range,
-        _horizontal_range,
-        _vert_num_frames,
-        _horiz_num_frames,
-        _enable_reverse_direction,
-        _use_centring_table,
-        _fast_scan,
-    ) -> int:
-        return self._add_task("Start RASTER SCAN", 5.2)
+    def _start_coroutine(self, coro: Coroutine) -> asyncio.Task:
+        """
+        Run the coroutine in the background, and keep track of it, so that it can be cancelled.
+        """
+        task = asyncio.create_task(coro)
+        self._coroutines.add(task)
+        task.add_done_callback(self._coroutines.discard)
 
-    async def _move_motors_simultaneously(
-        self, motors: list[MovedMotor], move_duration: float
-    ):
-        """Moves all motors simultaneously.
+        return task
 
-        Args:
-            motors: list of motors to move
+    def _cancel_activity(self) -> tuple[dict[MotorHandle, float], list[Task]]:
+        """
+        Cancel all in-flight moves and tasks, and mark the tasks as aborted.
+
+        Returns:
+            positions of the stopped motors, and the aborted tasks
+        """
+        for coroutine in self._coroutines:
+            coroutine.cancel()
+        # cancelled coroutines finish on the next loop iteration, forget them right away
+        self._coroutines.clear()
+
+        positions = self._motion.stop_all()
+        self._encoder.stop_all()
+
+        now = time()
+        tasks = []
+        for task_id in self._tasks.running():
+            task = self._tasks.finish(task_id)
+            if task.timer is not None:
+                task.timer.cancel()
+            task.end_time = now
+            task.aborted = True
+            if task.done is not None:
+                task.done.set()
+            tasks.append(task)
+        self._num_running_tasks = 0
+
+        return positions, tasks
+
+    def snapshot(self) -> dict:
+        """
+        Capture the state of the MD3, i.e. the attributes and the tasks, as JSON-able dict.
+
+        Moving motors are captured at their current positions, as stopped motors,
+        and running tasks as finished tasks.
+        """
+        attributes = {}
+        for name, attr in self._attrs.items():
+            val = self.read_attribute(name)
+            if attr.type == STATE and val in ("Moving", "Running"):
+                val = "Ready"
+            attributes[name] = val
+
+        return {"attributes": attributes, "tasks": self._tasks.snapshot()}
+
+    def check_snapshot(self, snapshot):
+        """
+        Check that the snapshot, e.g. loaded from a file, has the structure of a snapshot()
+        and values of the attribute types.
+
+        Raises:
+            ValueError: on an invalid snapshot
+        """
+
+        def check(valid: bool, error_msg: str):
+            if not valid:
+                raise ValueError(f"invalid snapshot, {error_msg}")
+
+        check(type(snapshot) is dict, "not an object")
+        attributes = snapshot.get("attributes")
+        tasks = snapshot.get("tasks")
+        check(type(attributes) is dict, "no attributes")
+        check(type(tasks) is dict, "no tasks")
+
+        for name, val in attributes.items():
+            attr = self._attrs.get(name)
+            check(attr is not None, f"unknown attribute '{name}'")
+            attr_type = type(attr.val)
+            # JSON does not tell integral doubles from integers
+            valid_types = (int, float) if attr_type is float else (attr_type,)
+            check(type(val) in valid_types, f"unexpected value of '{name}'")
+
+        check(type(tasks.get("last_id")) is int, "no last task ID")
+        check(type(tasks.get("tasks")) is list, "no task list")
+        for task in tasks["tasks"]:
+            check(
+                type(task) is list
+                and [type(field) for field in task] in _SNAPSHOT_TASK_TYPES,
+                f"unexpected task {task}",
+            )
+
+    def restore(self, snapshot: dict):
+        """
+        Restore the state captured by snapshot().
+
+        All in-flight moves and tasks are cancelled, and the encoder samples are dropped.
+        Only the attributes, which values differ from the snapshot, are updated, thus
+        events are sent only for those.
+        """
+        self._cancel_activity()
+        self._tasks.restore(snapshot["tasks"])
+        # the restored task IDs are reused, the samples are not part of the snapshot
+        self._encoder.clear()
+
+        timestamp = int(time())
+        for name, val in snapshot["attributes"].items():
+            attr = self._attrs.get(name)
+            if attr is None or attr.val == val:
+                continue
+
+            # the snapshot values are already checked and transformed
+            attr.assign(val)
+            self._attribute_updated_fan_out(attr.name, attr, timestamp)
+
+    def _task_finished(self, task_id: int):
+        task = self._tasks.finish(task_id)
+        task.end_time = time()
+        if task.done is not None:
+            task.done.set()
+
+        # like MD3, push the task completion to the clients, so they don't need to poll
+        self.write_attribute("LastTaskInfo", task.info())
+        self._num_running_tasks -= 1
+        if self._num_running_tasks == 0:
+            self.write_attribute("State", "Ready")
+
+    async def wait_task(self, task_id: int, timeout: float) -> list[str]:
+        """
+        Wait until the task is finished, or the timeout expires.
+
+        Returns:
+            the task info, as returned by getTaskInfo command
+        """
+        task = self._get_task(task_id)
+        if task.is_running():
+            if task.done is None:
+                task.done = asyncio.Event()
+            try:
+                await asyncio.wait_for(task.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        return task.info()
+
+    def _get_task(self, task_id: int) -> Task:
+        task = self._tasks.get(task_id)
+        if task is None:
+            raise CommandError(f"Invalid task: {task_id}")
+
+        return task
+
+    def _do_get_motor_limits(self, motor_name) -> tuple[float, float]:
+        limits = self._motors.get(motor_name)
+        if limits is None:
+            raise CommandError(f"Unknown motor: {motor_name}")
+
+        return limits
+
+    def _do_start_set_phase(self, phase) -> int:
+        phase_change_time = self._duration(PHASE_CHANGE, PHASE_CHANGE_TIME_SEC)
+
+        async def update_current_phase():
+            self.write_attribute("CurrentPhase", "Unknown")
+            await asyncio.sleep(phase_change_time)
+            self.write_attribute("CurrentPhase", phase)
+            if phase == "DataCollection":
+                self.write_attribute("BeamstopPosition", "BEAM")
+
+        if phase not in PHASES:
+            # MD3 error message when unexpected phase specified
+            raise CommandError(
+                "No method with the correct signature: true.startSetPhase"
+            )
+
+        self._start_coroutine(update_current_phase())
+        return self._add_task(f"Set {phase.upper()} PHASE", phase_change_time + 0.1)
+
+    def _do_start_raster_scan(
+        self,
+        vertical_range: float,
+        horizontal_range: float,
+        vert_num_frames: int,
+        horiz_num_frames: int,
+        enable_reverse_direction: bool,
+        use_centring_table: bool,
+        fast_scan: bool,
+    ) -> int:
+        """
+        Scan a grid of frames, centered at the current position, in vertical lines.
+
+        Each line takes vert_num_frames frames, exposed for ScanExposureTime seconds each,
+        and there are horiz_num_frames lines. The lines are scanned with AlignmentZ and
+        stepped with AlignmentY, or with CentringY and CentringX, if using the centring table.
+
+        The fast shutter is opened for each line, or for the whole scan in fast scan mode.
+        """
+        if vert_num_frames < 1 or horiz_num_frames < 1:
+            # MD3 error message when called with wrong arguments
+            raise CommandError(
+                "No method with the correct signature: true.startRasterScan"
+            )
+
+        # fail before starting the task, rather than when the shutter is opened
+        self._fast_shutter_direct_beam_check(True)
+
+        if use_centring_table:
+            vertical_motor, horizontal_motor = "CentringY", "CentringX"
+        else:
+            vertical_motor, horizontal_motor = "AlignmentZ", "AlignmentY"
+
+        plan = plan_raster_scan(
+            self._motor_position(vertical_motor),
+            self._motor_position(horizontal_motor),
+            vertical_range,
+            horizontal_range,
+            horiz_num_frames,
+            enable_reverse_direction,
+        )
+        line_time = vert_num_frames * self._attrs["ScanExposureTime"].val
+
+        async def raster_scan():
+            if fast_scan:
+                self.write_attribute("FastShutterIsOpen", True)
+
+            for horizontal, vertical_start, vertical_end in zip(
+                plan.horizontal.tolist(),
+                plan.vertical_start.tolist(),
+                plan.vertical_end.tolist(),
+            ):
+                # move to the start of the line
+                await self._move_motors_simultaneously(
+                    [
+                        MovedMotor(
+                            name=horizontal_motor,
+                            start_pos=self._motor_position(horizontal_motor),
+                            end_pos=horizontal,
+                        ),
+                        MovedMotor(
+                            name=vertical_motor,
+                            start_pos=self._motor_position(vertical_motor),
+                            end_pos=vertical_start,
+                        ),
+                    ],
+                    RASTER_LINE_TRANSITION_TIME_SEC,
+                )
+
+                if not fast_scan:
+                    self.write_attribute("FastShutterIsOpen", True)
+
+                await self._move_motors_simultaneously(
+                    [
+                        MovedMotor(
+                            name=vertical_motor,
+                            start_pos=vertical_start,
+                            end_pos=vertical_end,
+                        )
+                    ],
+                    line_time,
+                )
+
+                if not fast_scan:
+                    self.write_attribute("FastShutterIsOpen", False)
+
+            if fast_scan:
+                self.write_attribute("FastShutterIsOpen", False)
+
+        return self._start_task("Start RASTER SCAN", raster_scan())
+
+    def _motor_position_updated(self, motor: MotorHandle, position: float):
+        self._update_attribute(motor.position, position)
+
+    def _motor_stopped(self, motor: MotorHandle):
+        self._update_attribute(motor.state, "Ready")
+
+    def _move_motors_simultaneously(
+        self, motors: list[MovedMotor], move_duration: float
+    ) -> asyncio.Future:
+        """Moves all motors simultaneously.
+
+        Args:
+            motors: list of motors to move
             move_duration: time it takes to move all motors (in seconds)
+
+        Returns:
+            future, which is resolved when all motors have stopped
         """
 
-        for motor in motors:
-            state_attr = f"{motor.name}State"
-            self.write_attribute(state_attr, "Moving")
+        handles = [self._motor_handles[motor.name] for motor in motors]
+
+        for handle in handles:
+            self._update_attribute(handle.state, "Moving")
+
+        return asyncio.gather(
+            *[
+                self._motion.move(
+                    handle, motor.start_pos, motor.end_pos, move_duration, handle.wrap
+                )
+                for handle, motor in zip(handles, motors)
+            ]
+        )
 
-        for _ in range(MOTOR_STEPS):
-            for motor in motors:
-                pos_attr = f"{motor.name}Position"
-                current_pos = self._attrs[pos_attr].val
-                step = (motor.end_pos - motor.start_pos) / MOTOR_STEPS
-                new_pos = current_pos + step
-                if motor.name == "Omega":
-                    new_pos = _wrap_omega_position(new_pos)
-                self.write_attribute(pos_attr, new_pos)
+    def _motor_position(self, motor_name: str) -> float:
+        handle = self._motor_handles[motor_name]
+        position = self._motion.position(handle)
+        if position is None:
+            return handle.position.val
 
-            await asyncio.sleep(move_duration / MOTOR_STEPS)
+        return position
 
-        for motor in motors:
-            state_attr = f"{motor.name}State"
-            self.write_attribute(state_attr, "Ready")
+    def move_motor(self, motor_name: str, new_pos: float):
+        """
+        Emulate moving a motor, when its position attribute is written.
+        """
+        start_pos = self._motor_position(motor_name)
+        self._move_motors_simultaneously(
+            [MovedMotor(name=motor_name, start_pos=start_pos, end_pos=new_pos)],
+            self._duration(MOTOR_MOVE, MOTOR_MOVE_TIME_SEC),
+        )
 
     def _do_start_simultaneous_move_motors(self, motors_str: str) -> int:
         """Start a task to move motors simultaneously.
@@ -579,151 +1536,212 @@ class MD3Up:
         for motor_str in motors_str.split(";"):
             if "=" not in motor_str:
                 continue
-            name, pos_str = motor_str.split("=")
-            pos = float(pos_str)
+            name, _, pos_str = motor_str.partition("=")
+            try:
+                pos = float(pos_str)
+            except ValueError:
+                # MD3 error message when command is called with wrong arguments
+                raise CommandError(
+                    "No method with the correct signature: true.startSimultaneousMoveMotors"
+                )
             if name not in self._motors:
                 raise CommandError(f"Unknown motor: {name}")
-            start_pos = self._attrs[f"{name}Position"].val
+            start_pos = self._motor_position(name)
             motors.append(MovedMotor(name=name, start_pos=start_pos, end_pos=pos))
 
-        move_duration = 2.0
-        asyncio.create_task(
-            self._move_motors_simultaneously(motors, move_duration),
-        )
-        return self._add_task("Start Simultaneous Move Motors", move_duration)
+        move_time = self._duration(MOTOR_MOVE, MOTOR_MOVE_TIME_SEC)
+        self._move_motors_simultaneously(motors, move_time)
+        return self._add_task("Start Simultaneous Move Motors", move_time)
 
     def _do_start_scan_ex(
         self,
-        _frame_id,
-        start_angle,
-        scan_range,
-        exposure_time,
-        _number_of_passes,
+        _frame_id: int,
+        start_angle: float,
+        scan_range: float,
+        exposure_time: float,
+        _number_of_passes: int,
     ) -> int:
 
         # In MD3 exposure time dictates how long scan will take.
         # In reality, the task would take longer, because we need to first move omega to `start_angle` position.
         # Here it's simplified; the exposure time is whole task duration, and it takes same time to move, as for scan.
-        move_time = float(exposure_time) / 2
+        move_time = exposure_time / 2
+
+        _check_exposure_time("startScanEx", exposure_time)
+        # fail before starting the task, rather than when the shutter is opened
+        self._fast_shutter_direct_beam_check(True)
+
+        start_omega = _wrap_omega_position(start_angle)
+        # not wrapped, so that the scan rotates through 360 degrees
+        stop_omega = start_omega + scan_range
+        scanned = [MovedMotor(name="Omega", start_pos=start_omega, end_pos=stop_omega)]
 
         async def start_scan():
             self.write_attribute("FastShutterIsOpen", True)
 
-            start_omega = _wrap_omega_position(float(start_angle))
-            stop_omega = _wrap_omega_position(start_omega + float(scan_range))
-
             await self._move_motors_simultaneously(
                 [
                     MovedMotor(
                         name="Omega",
-                        start_pos=self._attrs["OmegaPosition"].val,
+                        start_pos=self._motor_position("Omega"),
                         end_pos=start_omega,
                     )
                 ],
                 move_time,
             )
-            await self._move_motors_simultaneously(
-                [MovedMotor(name="Omega", start_pos=start_omega, end_pos=stop_omega)],
-                move_time,
-            )
+            await self._move_motors_simultaneously(scanned, move_time)
             self.write_attribute("FastShutterIsOpen", False)
 
-        asyncio.create_task(start_scan())
-        return self._add_task("Start SCAN", float(exposure_time))
+        # the scanning starts, once omega is at the start angle
+        samples = self._allocate_encoder_samples(scanned, move_time, move_time)
+
+        task_id = self._start_task("Start SCAN", start_scan())
+        self._encoder.add(task_id, samples)
+        return task_id
 
     def _do_start_scan_4d_ex(
         self,
-        start_angle: str,
-        scan_range: str,
-        exposure_time: str,
-        start_y: str,
-        start_z: str,
-        start_cx: str,
-        start_cy: str,
-        stop_y: str,
-        stop_z: str,
-        stop_cx: str,
-        stop_cy: str,
+        start_angle: float,
+        scan_range: float,
+        exposure_time: float,
+        start_y: float,
+        start_z: float,
+        start_cx: float,
+        start_cy: float,
+        stop_y: float,
+        stop_z: float,
+        stop_cx: float,
+        stop_cy: float,
     ):
 
         # Time it takes to move to `start_angle` omega position.
         # Set as 1/6 of exposure time (which will act as task duration, like in self._do_start_scan_ex),
         # so that each motor move takes equal duration.
-        move_time = float(exposure_time) / 6
-
-        # Figure out omegas start and stop angles, in 0..360 range.
-        start_omega = _wrap_omega_position(float(start_angle))
-        stop_omega = _wrap_omega_position(start_omega + float(scan_range))
+        move_time = exposure_time / 6
+
+        _check_exposure_time("startScan4DEx", exposure_time)
+        # fail before starting the task, rather than when the shutter is opened
+        self._fast_shutter_direct_beam_check(True)
+
+        # Figure out omegas start and stop angles, the start in 0..360 range,
+        # the stop is not wrapped, so that the scan rotates through 360 degrees.
+        start_omega = _wrap_omega_position(start_angle)
+        stop_omega = start_omega + scan_range
+
+        motors_to_move = [
+            MovedMotor(name="Omega", start_pos=start_omega, end_pos=stop_omega),
+            MovedMotor(name="AlignmentY", start_pos=start_y, end_pos=stop_y),
+            MovedMotor(name="AlignmentZ", start_pos=start_z, end_pos=stop_z),
+            MovedMotor(name="CentringX", start_pos=start_cx, end_pos=stop_cx),
+            MovedMotor(name="CentringY", start_pos=start_cy, end_pos=stop_cy),
+        ]
 
         async def start_4d_scan():
             await self._move_motors_simultaneously(
                 [
                     MovedMotor(
                         name="Omega",
-                        start_pos=self._attrs["OmegaPosition"].val,
+                        start_pos=self._motor_position("Omega"),
                         end_pos=start_omega,
                     )
                 ],
                 move_time,
             )
 
-            motors_to_move = [
-                MovedMotor(name="Omega", start_pos=start_omega, end_pos=stop_omega),
-                MovedMotor(
-                    name="AlignmentY", start_pos=float(start_y), end_pos=float(stop_y)
-                ),
-                MovedMotor(
-                    name="AlignmentZ", start_pos=float(start_z), end_pos=float(stop_z)
-                ),
-                MovedMotor(
-                    name="CentringX", start_pos=float(start_cx), end_pos=float(stop_cx)
-                ),
-                MovedMotor(
-                    name="CentringY", start_pos=float(start_cy), end_pos=float(stop_cy)
-                ),
-            ]
-
             self.write_attribute("FastShutterIsOpen", True)
 
             await self._move_motors_simultaneously(motors_to_move, 5 * move_time)
 
             self.write_attribute("FastShutterIsOpen", False)
 
-        asyncio.create_task(start_4d_scan())
-        return self._add_task("Start 4D-SCAN", float(exposure_time))
-
-    def _do_is_task_running(self, task_id) -> bool:
-        task = self._get_task(task_id)
-        return task.is_running()
+        # the scanning starts, once omega is at the start angle
+        samples = self._allocate_encoder_samples(
+            motors_to_move, move_time, 5 * move_time
+        )
 
-    def _do_get_task_info(self, task_id):
-        def get_reply_vals():
-            if task.is_running():
-                return "", "", "", ""
+        task_id = self._start_task("Start 4D-SCAN", start_4d_scan())
+        self._encoder.add(task_id, samples)
+        return task_id
 
-            # finished, aka not running
-            return epoch_as_text(task.end_time), "true", "null", "1"
+    def _allocate_encoder_samples(
+        self, motors: list[MovedMotor], lead_time: float, duration: float
+    ) -> Optional[EncoderBuffer]:
+        """
+        Allocate the encoder samples of a scan, that starts after the lead time.
+        """
+        return self._encoder.allocate(
+            [
+                ScannedAxis(
+                    motor.name, motor.start_pos, motor.end_pos, _motor_wrap(motor.name)
+                )
+                for motor in motors
+            ],
+            time() + lead_time,
+            duration,
+        )
 
-        task = self._get_task(task_id)
-        end_time, result, exception, result_id = get_reply_vals()
+    def get_encoder_samples_info(self, task_id: int) -> list[str]:
+        """
+        Describe the encoder samples of a scan.
 
+        Returns:
+            sample rate, number of samples, number of samples acquired so far,
+            followed by the names of the sample columns
+        """
+        samples = self._get_encoder_samples(task_id)
         return [
-            task.name,
-            "8",
-            epoch_as_text(task.start_time),
-            end_time,
-            result,
-            exception,
-            result_id,
+            str(samples.rate),
+            str(len(samples)),
+            str(samples.acquired()),
+            *samples.columns,
         ]
 
+    def get_encoder_samples(self, task_id: int, offset: int, count: int) -> list[float]:
+        """
+        Read a page of the encoder samples of a scan.
+
+        Returns:
+            up to 'count' acquired samples, starting at sample 'offset', flattened row by row
+        """
+        if offset < 0 or count < 0:
+            raise CommandError(f"Invalid samples range: {offset}, {count}")
+
+        page = self._get_encoder_samples(task_id).read(
+            offset, min(count, ENCODER_PAGE_SIZE)
+        )
+        return page.ravel().tolist()
+
+    def _get_encoder_samples(self, task_id: int):
+        samples = self._encoder.get(task_id)
+        if samples is None:
+            raise CommandError(f"No encoder samples for task: {task_id}")
+
+        return samples
+
+    def _do_is_task_running(self, task_id: int) -> bool:
+        task = self._get_task(task_id)
+        return task.is_running()
+
+    def _do_get_task_info(self, task_id: int):
+        return self._get_task(task_id).info()
+
     def _do_save_centring_positions(self):
         # this is NOP for now
         pass
 
     def _do_abort(self):
-        # this is NOP for now
-        pass
+        positions, tasks = self._cancel_activity()
+
+        # the motors stay where they were stopped
+        for handle, position in positions.items():
+            self._update_attribute(handle.position, position)
+            self._update_attribute(handle.state, "Ready")
+
+        self.write_attribute("FastShutterIsOpen", False)
+
+        if tasks:
+            self.write_attribute("LastTaskInfo", tasks[-1].info())
+            self.write_attribute("State", "Ready")
 
     def _do_get_beamstop_position(self):
         return self._attrs["BeamstopPosition"].val
@@ -737,7 +1755,9 @@ class MD3Up:
 
         async def update_beamstop_pos():
             self.write_attribute("BeamstopPosition", "UNKNOWN")
-            await asyncio.sleep(BEAMSTOP_TRAVEL_TIME_SEC)
+            await asyncio.sleep(
+                self._duration(BEAMSTOP_TRAVEL, BEAMSTOP_TRAVEL_TIME_SEC)
+            )
             self.write_attribute("BeamstopPosition", position)
 
         if position not in BEAMSTOP_POSITIONS:
@@ -748,7 +1768,7 @@ class MD3Up:
 
         cur_pos = self._attrs["BeamstopPosition"].val
 
-        if cur_pos == "UNKNOWN":
+        if self._beamstop_move in self._coroutines:
             # beam-stop is currently moving
             raise CommandError("Cannot execute command: motor is moving")
 
@@ -756,7 +1776,8 @@ class MD3Up:
             # already at requested position, NOP
             return
 
-        asyncio.create_task(update_beamstop_pos())
+        # an aborted move leaves the beamstop at UNKNOWN position, from where it can be moved
+        self._beamstop_move = self._start_coroutine(update_beamstop_pos())
 
     def _do_set_alignment_table_position(self, position):
         # basically NOP for now
@@ -771,14 +1792,44 @@ class MD3Up:
         return [-2.97366048458438, 2.970646846947152]
 
     def add_attribute_updated_callback(
-        self, attribute_update_cb: AttributeUpdatedCallback
+        self,
+        attribute_update_cb: AttributeUpdatedCallback,
+        attribute_names: Optional[Iterable[str]] = None,
     ):
-        self._attr_updated_callbacks.add(attribute_update_cb)
+        """
+        Subscribe the callback to attribute updates.
+
+        Args:
+            attribute_names: subscribe to updates of these attributes, or to all attributes if None
+        """
+        if attribute_names is None:
+            self._all_attrs_updated_callbacks.add(attribute_update_cb)
+            self._callback_subscriptions[attribute_update_cb] = None
+            return
+
+        attribute_names = frozenset(attribute_names)
+        for name in attribute_names:
+            self._attr_updated_callbacks.setdefault(name, set()).add(
+                attribute_update_cb
+            )
+        self._callback_subscriptions[attribute_update_cb] = attribute_names
 
     def remove_attribute_updated_callback(
         self, attribute_update_cb: AttributeUpdatedCallback
     ):
-        self._attr_updated_callbacks.remove(attribute_update_cb)
+        attribute_names = self._callback_subscriptions.pop(attribute_update_cb)
+        if attribute_names is None:
+            self._all_attrs_updated_callbacks.remove(attribute_update_cb)
+            return
+
+        for name in attribute_names:
+            self._attr_updated_callbacks[name].remove(attribute_update_cb)
+
+    def is_subscribed(
+        self, attribute_update_cb: AttributeUpdatedCallback, attribute_name: str
+    ) -> bool:
+        attribute_names = self._callback_subscriptions[attribute_update_cb]
+        return attribute_names is None or attribute_name in attribute_names
 
     def get_motor_name(self, attribute_name: str) -> Optional[str]:
         """
@@ -787,15 +1838,52 @@ class MD3Up:
 
         For example returns 'Omega' for 'OmegaPosition', and for 'FooBarAttribute' returns None.
         """
-        if not attribute_name.endswith("Position"):
+        handle = self._motor_position_attrs.get(attribute_name)
+        if handle is None:
             return None
 
-        motor_name = attribute_name[: -len("Position")]
-        if motor_name not in self._motors:
-            # does not seem to be a motor
+        return handle.name
+
+    def get_motor_position_attribute(self, state_attribute_name: str) -> Optional[str]:
+        """
+        For a motor state attribute, returns the motor's position attribute name.
+        If not a motor state attribute, return None.
+
+        For example returns 'OmegaPosition' for 'OmegaState'.
+        """
+        handle = self._motor_state_attrs.get(state_attribute_name)
+        if handle is None:
             return None
 
-        return motor_name
+        return handle.position.name
+
+    def read_attribute(self, attribute_name: str):
+        """
+        Get the current value of an attribute.
+
+        The positions of moving motors are computed from their trajectories,
+        thus they are exact, also between the position events.
+        """
+        attr = self.get_attribute(attribute_name)
+
+        handle = self._motor_position_attrs.get(attribute_name)
+        if handle is not None:
+            position = self._motion.position(handle)
+            if position is not None:
+                return position
+
+        return attr.val
+
+    def list_attributes(self):
+        yield from self._attrs.items()
+
+    def count_running_tasks(self) -> int:
+        return self._num_running_tasks
+
+    def count_moving_motors(self) -> int:
+        return sum(
+            1 for handle in self._motor_handles.values() if handle.state.val == "Moving"
+        )
 
     def get_attribute(self, attribute_name: str) -> Attribute:
         attr = self._attrs.get(attribute_name)
@@ -806,107 +1894,491 @@ class MD3Up:
 
     def write_attribute(
         self, attribute_name: str, attribute_value, timestamp: None | int = None
+    ):
+        attr = self.get_attribute(attribute_name)
+        self._update_attribute(attr, attribute_value, timestamp)
+
+        return attr
+
+    def _update_attribute(
+        self, attr: Attribute, attribute_value, timestamp: None | int = None
     ):
         if timestamp is None:
             timestamp = int(time())
 
-        attr = self.get_attribute(attribute_name)
         attr.val = attribute_value
 
-        for attr_cb in self._attr_updated_callbacks:
+        if profiler.enabled:
+            profiler.call(
+                CALLBACKS,
+                attr.name,
+                attribute_value,
+                self._attribute_updated_fan_out,
+                attr.name,
+                attr,
+                timestamp,
+            )
+        else:
+            self._attribute_updated_fan_out(attr.name, attr, timestamp)
+
+    def _attribute_updated_fan_out(
+        self, attribute_name: str, attr: Attribute, timestamp: int
+    ):
+        for attr_cb in self._all_attrs_updated_callbacks:
             attr_cb(attribute_name, attr, timestamp)
 
-        return attr
+        for attr_cb in self._attr_updated_callbacks.get(attribute_name, ()):
+            attr_cb(attribute_name, attr, timestamp)
 
     def list_commands(self):
         for name, (ret_type, args, _) in self._commands.items():
             yield name, ret_type, args
 
     def exec_command(self, command_name, command_args):
+        if profiler.enabled:
+            return profiler.call(
+                COMMAND,
+                command_name,
+                command_args,
+                self._exec_command,
+                command_name,
+                command_args,
+            )
+
+        return self._exec_command(command_name, command_args)
+
+    def _exec_command(self, command_name, command_args):
         cmd = self._commands.get(command_name)
         if cmd is None:
-            log(f"ERROR: unknown command: {command_name}")
+            if log.errors:
+                log.error(f"unknown command: {command_name}")
             raise UnknownCommand()
 
         _, _, cmd_method = cmd
-        return cmd_method(*command_args)
+        args = self._command_args_parsers[command_name](command_args)
+
+        return cmd_method(*args)
+
+
+def decode_args(args: memoryview) -> str:
+    return str(args, "utf-8")
+
+
+def _request_name(args: memoryview) -> str:
+    """
+    Get the command or the (first) attribute name, of request's arguments.
+    """
+    name, _, _ = decode_args(args).partition(" ")
+    name, _, _ = name.partition(ARG_SEP)
+
+    return name
+
+
+class ExporterProtocol(asyncio.Protocol):
+    """
+    A client connection to the exporter.
+
+    Splits the STX/ETX framed messages out of the received data, without copying it,
+    and hands them over to the exporter. All replies to the messages received in one go,
+    are sent back to the client with a single write.
+
+    Requests are handled one after another. When a command defers its reply, the
+    following requests are not handled until the deferred reply is sent, i.e. they
+    see the state after the deferred command has completed, as on the MD3.
+    """
+
+    def __init__(self, exporter: "Exporter"):
+        self._exporter = exporter
+        # a partial message, received so far
+        self._buffer = bytearray()
+        self.events = EventQueue(EVENT_QUEUE_SIZE)
+        # sends the deferred reply, while it's pending the received messages are withheld
+        self._deferred_reply: Optional[asyncio.Task] = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        log.info("MD3 new connection")
+        self._transport = transport
+        host, port = transport.get_extra_info("peername")[:2]
+        self.peer = f"{host}:{port}"
+        self.writer = TransportWriter(transport, self._exporter.new_capture(self))
+        self._exporter.client_connected(self)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        log.info("connection closed")
+        self._exporter.client_disconnected(self)
+
+        if self._deferred_reply is not None:
+            self._deferred_reply.cancel()
+
+        if self.writer.capture is not None:
+            self.writer.capture.close()
+
+    def pause_writing(self):
+        self.writer.pause()
+
+    def resume_writing(self):
+        self.writer.resume()
+
+    def data_received(self, data: bytes):
+        if log.traffic:
+            log.debug(f"> {data}")
+
+        self._exporter.metrics.received_bytes.inc(len(data))
+
+        if self._buffer or self._deferred_reply is not None:
+            # append to the previously received partial or withheld messages
+            self._buffer += data
+            data = self._buffer
+
+        if self._deferred_reply is not None:
+            # the messages are handled once the deferred reply is sent
+            return
+
+        self._handle_messages(data)
+
+    def _handle_messages(self, data: bytes | bytearray):
+        replies = []
+        deferred_reply = None
+        start = 0
+        try:
+            with memoryview(data) as view:
+                while True:
+                    end = data.find(ETX, start)
+                    if end == -1:
+                        break
+
+                    # assert that message starts with STX byte
+                    assert data[start] == STX[0]
+
+                    # chop off STX and ETX bytes
+                    msg = view[start + 1 : end]
+                    if self.writer.capture is not None:
+                        self.writer.capture.inbound(msg)
+
+                    reply = self._exporter.handle_message(msg, self)
+                    start = end + 1
+
+                    if type(reply) is not bytes:
+                        deferred_reply = reply
+                        break
+
+                    replies.append(reply)
+        except Exception as ex:
+            log.exception(ex)
+            self._transport.close()
+            return
+
+        self._buffer = bytearray(data[start:])
+        self._exporter.write_messages(self.writer, replies, log.traffic)
+
+        if deferred_reply is not None:
+            # stop reading, until the deferred reply is sent
+            self._transport.pause_reading()
+            self._deferred_reply = asyncio.create_task(
+                self._write_deferred_reply(deferred_reply)
+            )
+
+    async def _write_deferred_reply(self, reply: asyncio.Future):
+        reply = await reply
+        self._exporter.write_messages(self.writer, [reply], log.traffic)
+
+        self._deferred_reply = None
+        self._transport.resume_reading()
+        # handle the messages, that were received while waiting
+        self._handle_messages(self._buffer)
+
+
+class ExporterMetrics:
+    def __init__(self, registry: Registry):
+        self.messages = registry.counter(
+            "md3_messages_total", "Received messages, by verb.", "verb"
+        )
+        self.exec_duration = registry.histogram(
+            "md3_exec_duration_seconds",
+            "Execution time of EXEC commands, by command.",
+            "command",
+        )
+        self.events = registry.counter(
+            "md3_events_total", "Emitted attribute events, by attribute.", "attribute"
+        )
+        self.received_bytes = registry.counter(
+            "md3_received_bytes_total", "Bytes received from clients."
+        )
+        self.sent_bytes = registry.counter(
+            "md3_sent_bytes_total", "Bytes sent to clients."
+        )
 
 
 class Exporter:
-    def __init__(self):
-        self._md3 = MD3Up()
+    def __init__(
+        self,
+        md3: Optional[MD3Up] = None,
+        capture_dir: Optional[str] = None,
+        event_filters: Optional[dict[str, EventFilterConfig]] = None,
+        snapshot_dir: Optional[str] = None,
+        latency: Optional[LatencyProfile] = None,
+        profile_dir: Optional[str] = None,
+    ):
+        """
+        Args:
+            capture_dir: if specified, record messages of each client connection
+                         to a capture file in this directory
+            event_filters: deadband and rate limit configuration for attribute events
+            snapshot_dir: if specified, MD3 state snapshots are also saved to,
+                          and loaded from, JSON files in this directory
+            latency: if specified, replies are delayed by latencies sampled from this profile
+            profile_dir: if specified, profiling statistics can be dumped to pstats
+                         files in this directory
+        """
+        self._md3 = MD3Up() if md3 is None else md3
+        self._capture_dir = capture_dir
+        if capture_dir is not None:
+            # fail at startup, rather than on each client connection
+            os.makedirs(capture_dir, exist_ok=True)
+        self._snapshot_dir = snapshot_dir
+        self._latency = latency
+        self._profile_dir = profile_dir
+        # snapshot name -> MD3 state snapshot
+        self._snapshots = {INITIAL_SNAPSHOT: self._md3.snapshot()}
+        self._event_filter = EventFilter(
+            {} if event_filters is None else event_filters, self._send_trailing_event
+        )
 
-    async def _write_reply(self, writer: SynchronizedWriter, reply: str):
-        msg = STX + reply.encode() + ETX
+        # attribute name -> (attribute version, encoded EVT message, or None if event is filtered out)
+        self._event_cache: dict[str, tuple[int, Optional[bytes]]] = {}
+        # ((timestamp, attribute versions), encoded initial EVT messages)
+        self._initial_events_cache: Optional[tuple[tuple, bytes]] = None
 
-        await writer.write_drain(msg)
+        self.metrics_registry = Registry()
+        self.metrics = ExporterMetrics(self.metrics_registry)
+        self.metrics_registry.gauge(
+            "md3_connections", "Connected clients.", lambda: len(self._clients)
+        )
+        self.metrics_registry.gauge(
+            "md3_event_queue_depth",
+            "Events waiting to be sent, by client connection.",
+            lambda: {client.peer: len(client.events) for client in list(self._clients)},
+            "connection",
+        )
+        self.metrics_registry.gauge(
+            "md3_moving_motors",
+            "Motors currently moving.",
+            self._md3.count_moving_motors,
+        )
+        self.metrics_registry.gauge(
+            "md3_running_tasks",
+            "MD3 tasks currently running.",
+            self._md3.count_running_tasks,
+        )
 
-        log(f"< {msg}")
+        # connected client -> (attributes update callback, events writer task)
+        self._clients: dict[
+            ExporterProtocol, tuple[AttributeUpdatedCallback, asyncio.Task]
+        ] = {}
+
+        self._message_handlers: dict[
+            bytes, Callable[[memoryview, ExporterProtocol], str | asyncio.Future]
+        ] = {
+            READ: self._handle_read,
+            WRTE: self._handle_write,
+            EXEC: self._handle_exec,
+            LIST: self._handle_list,
+            NAME: self._handle_name,
+            SUBS: self._handle_subscribe,
+        }
 
-    async def _read_message(self, reader: StreamReader) -> str:
-        message = await reader.readuntil(ETX)
+        # exporter extension, commands for administrating the emulator, they are
+        # executed with EXEC, but not listed with LIST
+        self._admin_commands = {
+            # void setProfilingEnabled(boolean)
+            "setProfilingEnabled": ("void", "boolean", self._do_set_profiling_enabled),
+            # String[] getProfilingSlowest()
+            "getProfilingSlowest": ("String[]", "", self._do_get_profiling_slowest),
+            # void resetProfiling()
+            "resetProfiling": ("void", "", self._do_reset_profiling),
+            # void dumpProfilingStats(String), dumps the statistics to the named
+            # file in the profile directory
+            "dumpProfilingStats": ("void", "String", self._do_dump_profiling_stats),
+            # String[] waitTaskDone(int, double), the reply is deferred until the task
+            # is finished or the timeout in seconds expires, returns the task info
+            "waitTaskDone": ("String[]", "int, double", self._md3.wait_task),
+            # String[] getEncoderSamplesInfo(int)
+            "getEncoderSamplesInfo": (
+                "String[]",
+                "int",
+                self._md3.get_encoder_samples_info,
+            ),
+            # double[] getEncoderSamples(int, int, int), arguments are task ID,
+            # offset and count of samples
+            "getEncoderSamples": (
+                "double[]",
+                "int, int, int",
+                self._md3.get_encoder_samples,
+            ),
+            # void saveSnapshot(String), saves the MD3 state under the name
+            "saveSnapshot": ("void", "String", self._do_save_snapshot),
+            # void restoreSnapshot(String), restores the named MD3 state, the state
+            # at the emulator start is named 'initial'
+            "restoreSnapshot": ("void", "String", self._do_restore_snapshot),
+        }
+        self._admin_command_args_parsers = {
+            name: compile_args_parser(name, args_signature)
+            for name, (_, args_signature, _) in self._admin_commands.items()
+        }
+
+    def write_messages(
+        self, writer: TransportWriter, msgs: list[bytes], log_msgs: bool
+    ):
+        """
+        Send multiple messages to the client with a single write.
+
+        Args:
+            log_msgs: log the sent messages
+        """
+        if not msgs:
+            return
 
-        log(f"> {message}")
+        data = b"".join(msgs)
+        writer.write(data)
+        self.metrics.sent_bytes.inc(len(data))
 
-        # assert that message starts with STX byte
-        assert message[0] == STX[0]
+        if writer.capture is not None:
+            for msg in msgs:
+                writer.capture.outbound(msg)
 
-        # chop off STX and ETX bytes
-        return message[1:-1].decode()
+        if log_msgs:
+            for msg in msgs:
+                log.debug(f"< {msg}")
 
-    async def _send_evt_message(
-        self, writer: SynchronizedWriter, attr_name, attr_val, attr_type, timestamp
+    async def _write_events(self, writer: TransportWriter, events: EventQueue):
+        """
+        Send queued EVT messages to the client, for as long as the connection is open.
+        """
+        while True:
+            # while the client is not reading, keep events in the queue, where they are coalesced
+            await writer.wait_writable()
+            self.write_messages(writer, await events.get_all(), log.events)
+
+    def _encode_event_message(
+        self, attr_name: str, attr: Attribute, timestamp: int
+    ) -> bytes:
+        msg = encode_event(attr_name, attr.val, timestamp, attr.type)
+        self._event_cache[attr_name] = (attr.version, msg)
+        self.metrics.events.inc(label_value=attr_name)
+
+        return msg
+
+    def _get_event_message(
+        self, attr_name: str, attr: Attribute, timestamp: int
+    ) -> Optional[bytes]:
+        """
+        Get the encoded EVT message for the current version of an attribute.
+
+        The message is only encoded once per attribute update, all connected
+        clients are sent the same bytes object.
+
+        Returns:
+            the message, or None if the update is filtered out
+        """
+        cached = self._event_cache.get(attr_name)
+        if cached is not None and cached[0] == attr.version:
+            return cached[1]
+
+        if not self._event_filter.accept(attr_name, attr):
+            self._event_cache[attr_name] = (attr.version, None)
+            return None
+
+        position_attr_name = self._md3.get_motor_position_attribute(attr_name)
+        if position_attr_name is not None:
+            # the final position of a move is sent before the motor state change,
+            # so clients acting on the state see the up-to-date position
+            self._event_filter.flush(position_attr_name)
+
+        return self._encode_event_message(attr_name, attr, timestamp)
+
+    def _send_trailing_event(self, attr_name: str):
+        """
+        Send the latest value of an attribute, which was withheld by the event filter.
+        """
+        attr = self._md3.get_attribute(attr_name)
+        msg = self._encode_event_message(attr_name, attr, int(time()))
+        self._event_filter.emitted(attr_name, attr.val)
+
+        for client, (attrs_update_callback, _) in self._clients.items():
+            if self._md3.is_subscribed(attrs_update_callback, attr_name):
+                self._queue_event(client.events, attr_name, attr, msg)
+
+    def _queue_event(
+        self, events: EventQueue, attr_name: str, attr: Attribute, msg: bytes
     ):
-        val = encode_val(attr_val)
-        msg = f"EVT:{attr_name}\t{val}\t{timestamp}\t{attr_type}"
-        await self._write_reply(writer, msg)
+        # only the latest position and state values are of interest to a lagging client
+        events.put(attr_name, msg, coalesce=attr.type in (DOUBLE, STATE))
 
     def _attribute_updated(
         self,
-        writer: SynchronizedWriter,
+        events: EventQueue,
         attr_name: str,
         attr: Attribute,
         timestamp: int,
     ):
-        asyncio.create_task(
-            self._send_evt_message(writer, attr_name, attr.val, attr.type, timestamp)
-        )
+        msg = self._get_event_message(attr_name, attr, timestamp)
+        if msg is None:
+            return
 
-    async def _move_motor(
-        self, writer: SynchronizedWriter, motor_name: str, new_pos: float
-    ):
-        motor_pos_attr = f"{motor_name}Position"
-        motor_state_attr = f"{motor_name}State"
+        self._queue_event(events, attr_name, attr, msg)
 
-        start_pos = self._md3.get_attribute(motor_pos_attr).val
-        step = (new_pos - start_pos) / MOTOR_STEPS
+    def _handle_read(self, args: memoryview, _client: ExporterProtocol) -> str:
+        """
+        Besides reading a single attribute, two extensions of the MD3 protocol are supported.
 
-        self._md3.write_attribute(motor_state_attr, "Moving")
+        Multiple attributes, separated by tabs, can be read at once, e.g. 'READ OmegaPosition\tOmegaState'.
+        The reply is an array of the attribute values, in the requested order.
 
-        for n in range(1, MOTOR_STEPS + 1):
-            step_pos = start_pos + (n * step)
+        All attributes are read with 'READ *'. The reply is an array of name and value pairs,
+        e.g. [Name1, value1, Name2, value2, ...].
 
-            # Omega is a rotation angle motor, thus a special case.
-            # MD3 automatically wraps any set value within 0..360 degrees range.
-            if motor_name == "Omega":
-                step_pos = _wrap_omega_position(step_pos)
+        In both cases, the values of array attributes are encoded as comma separated lists.
+        """
 
-            self._md3.write_attribute(motor_pos_attr, step_pos)
-            await asyncio.sleep(2 / MOTOR_STEPS)
+        def encode_element(val) -> str:
+            if type(val) in (list, tuple):
+                return ",".join(encode_val(v) for v in val)
 
-        self._md3.write_attribute(motor_state_attr, "Ready")
+            return encode_val(val)
 
-    def _handle_read(self, attr_name: str) -> str:
-        try:
-            attr = self._md3.get_attribute(attr_name)
-            return f"RET:{encode_val(attr.val)}"
-        except UnknownAttribute:
-            log(f"WARNING: read command for an unknown attribute '{attr_name}'")
-            # this seems to be the error message MD3UP generates for unknown attributes
-            return f"ERR:Undefined method: true.get{attr_name}"
-
-    def _handle_write(self, slug: str, writer: SynchronizedWriter) -> str:
-        name, val = slug.split(" ", 2)
+        def read_all():
+            for attr_name, _ in self._md3.list_attributes():
+                yield attr_name
+                yield encode_element(self._md3.read_attribute(attr_name))
+
+        attr_names = decode_args(args)
+
+        if attr_names == ALL_ATTRIBUTES:
+            return f"RET:{encode_val(list(read_all()))}"
+
+        vals = []
+        for attr_name in attr_names.split(ARG_SEP):
+            try:
+                vals.append(self._md3.read_attribute(attr_name))
+            except UnknownAttribute:
+                if log.errors:
+                    log.warning(f"read command for an unknown attribute '{attr_name}'")
+                # this seems to be the error message MD3UP generates for unknown attributes
+                return f"ERR:Undefined method: true.get{attr_name}"
+
+        if len(vals) == 1:
+            return f"RET:{encode_val(vals[0])}"
+
+        return f"RET:{encode_val([encode_element(val) for val in vals])}"
+
+    def _handle_write(self, args: memoryview, client: ExporterProtocol) -> str:
+        name, val = decode_args(args).split(" ", 2)
+        if profiler.enabled:
+            return profiler.call(WRITE, name, val, self._write, name, val, client)
+
+        return self._write(name, val, client)
+
+    def _write(self, name: str, val: str, client: ExporterProtocol) -> str:
         attr_type = type(self._md3.get_attribute(name).val)
         val = parse_val(attr_type, val)
 
@@ -917,22 +2389,116 @@ class Exporter:
                 self._md3.write_attribute(name, val)
             else:
                 # this is a motor position attribute, emulate moving motor
-                asyncio.create_task(self._move_motor(writer, motor_name, val))
+                self._md3.move_motor(motor_name, val)
         except DisallowedState as invalid_state_err:
             return f"ERR:{str(invalid_state_err)}"
 
         return "NULL"
 
-    def _handle_exec(self, command: str) -> str:
-        cmd_name, args = command.split(" ", 1)
+    def _do_set_profiling_enabled(self, enabled: bool):
+        if enabled:
+            profiler.enable()
+        else:
+            profiler.disable()
+
+    def _do_get_profiling_slowest(self) -> list[str]:
+        return [str(invocation) for invocation in profiler.slowest()]
+
+    def _do_reset_profiling(self):
+        profiler.reset()
+
+    def _do_dump_profiling_stats(self, name: str):
+        if self._profile_dir is None:
+            raise CommandError("no profile directory configured")
+        if not name or os.path.basename(name) != name:
+            raise CommandError(f"invalid profile name '{name}'")
+
+        try:
+            profiler.dump_stats(os.path.join(self._profile_dir, name))
+        except (ValueError, OSError) as ex:
+            raise CommandError(str(ex))
+
+    def _snapshot_path(self, name: str) -> str:
+        if not name or os.path.basename(name) != name:
+            raise CommandError(f"invalid snapshot name '{name}'")
+
+        return os.path.join(self._snapshot_dir, f"{name}.json")
+
+    def _do_save_snapshot(self, name: str):
+        if name == INITIAL_SNAPSHOT:
+            raise CommandError(f"snapshot name '{name}' is reserved")
+
+        snapshot = self._md3.snapshot()
+
+        if self._snapshot_dir is not None:
+            try:
+                with open(self._snapshot_path(name), "w") as f:
+                    json.dump(snapshot, f)
+            except OSError as ex:
+                raise CommandError(str(ex))
+
+        self._snapshots[name] = snapshot
+
+    def _do_restore_snapshot(self, name: str):
+        snapshot = self._snapshots.get(name)
+
+        if snapshot is None and self._snapshot_dir is not None:
+            try:
+                with open(self._snapshot_path(name)) as f:
+                    snapshot = json.load(f)
+                # fail before any activity is cancelled
+                self._md3.check_snapshot(snapshot)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as ex:
+                raise CommandError(str(ex))
+
+        if snapshot is None:
+            raise CommandError(f"unknown snapshot '{name}'")
+
+        self._md3.restore(snapshot)
+
+    async def _deferred_reply(self, ret: Awaitable) -> bytes:
+        try:
+            ret = await ret
+        except CommandError as cmd_err:
+            return encode_message(f"ERR:{str(cmd_err)}")
+
+        return encode_message(f"RET:{encode_val(ret)}")
+
+    def _exec_admin_command(
+        self, cmd_name: str, args: list[str]
+    ) -> str | asyncio.Future:
+        _, _, cmd_method = self._admin_commands[cmd_name]
+        try:
+            ret = cmd_method(*self._admin_command_args_parsers[cmd_name](args))
+        except CommandError as cmd_err:
+            return f"ERR:{str(cmd_err)}"
+
+        if inspect.isawaitable(ret):
+            return asyncio.ensure_future(self._deferred_reply(ret))
+
+        return f"RET:{encode_val(ret)}"
+
+    def _handle_exec(
+        self, args: memoryview, _client: ExporterProtocol
+    ) -> str | asyncio.Future:
+        cmd_name, _, args = decode_args(args).partition(" ")
         if args == "":
             # no arguments specified
             args = []
         else:
-            args = args.strip().split("\t")
+            args = args.strip().split(ARG_SEP)
 
+        if cmd_name in self._admin_commands:
+            return self._exec_admin_command(cmd_name, args)
+
+        start = perf_counter()
         try:
             ret = self._md3.exec_command(cmd_name, args)
+            self.metrics.exec_duration.observe(perf_counter() - start, cmd_name)
+        except UnknownCommand:
+            return f"ERR:Undefined method: true.{cmd_name}"
         except CommandError as cmd_err:
             return f"ERR:{str(cmd_err)}"
         except DisallowedState as invalid_state_err:
@@ -940,89 +2506,166 @@ class Exporter:
 
         return f"RET:{encode_val(ret)}"
 
-    def _handle_list(self) -> str:
+    def _handle_list(self, _args: memoryview, _client: ExporterProtocol) -> str:
         def commands():
             for name, ret_type, args in self._md3.list_commands():
                 yield f"{ret_type} {name}({args})"
 
-        cmds = "\t".join(list(commands()))
+        cmds = ARG_SEP.join(list(commands()))
 
         return f"RET:{cmds}"
 
-    async def _send_initial_events(self, writer: SynchronizedWriter):
-        async def send_message(attr_name, msg_name):
-            attr = self._md3.get_attribute(attr_name)
-            await self._send_evt_message(
-                writer, msg_name, attr.val, attr.type, timestamp
-            )
+    def _handle_name(self, _args: memoryview, _client: ExporterProtocol) -> str:
+        return "RET:MD"
+
+    def _handle_subscribe(self, args: memoryview, client: ExporterProtocol) -> str:
+        """
+        Exporter protocol extension, limits the events sent to the client.
+
+        'SUBS OmegaPosition\tOmegaState' subscribes the client to events of the specified
+        attributes only, 'SUBS *' subscribes the client to events of all attributes.
+        """
+        attr_names = decode_args(args)
+        if attr_names == ALL_ATTRIBUTES:
+            attr_names = None
+        else:
+            attr_names = attr_names.split(ARG_SEP)
+            for attr_name in attr_names:
+                try:
+                    self._md3.get_attribute(attr_name)
+                except UnknownAttribute:
+                    return f"ERR:Undefined attribute: {attr_name}"
 
+        attrs_update_callback, _ = self._clients[client]
+        self._md3.remove_attribute_updated_callback(attrs_update_callback)
+        self._md3.add_attribute_updated_callback(attrs_update_callback, attr_names)
+
+        return "NULL"
+
+    def _get_initial_events(self) -> bytes:
+        """
+        Get the encoded EVT messages, sent to a client when it connects.
+
+        All messages are returned as a single buffer, which is cached for as long as
+        the involved attributes are not updated, and the event timestamp does not change.
+        """
         timestamp = int(time())
+        attrs = [
+            (self._md3.get_attribute(attr_name), msg_name)
+            for attr_name, msg_name in INITIAL_EVENT_ATTRIBUTES
+        ]
+        cache_key = (timestamp, [attr.version for attr, _ in attrs])
 
-        await send_message("State", "State")
-        await send_message("Status", "Status")
+        if self._initial_events_cache is not None:
+            key, msgs = self._initial_events_cache
+            if key == cache_key:
+                return msgs
 
-        for name in INITIAL_EVENTS:
-            state = f"{name}State"
-            position = f"{name}Position"
-            await send_message(state, state)
-            await send_message(position, state)
+        buf = bytearray()
+        for attr, msg_name in attrs:
+            encode_event_into(buf, msg_name, attr.val, timestamp, attr.type)
+        msgs = bytes(buf)
+        self._initial_events_cache = (cache_key, msgs)
 
-        await send_message("DetectorState", "DetectorState")
-        await send_message("DetectorDistance", "DetectorState")
+        return msgs
 
-        # MD3 sends CurrentApertureDiameterIndex event twice for some reason
-        await send_message(
-            "CurrentApertureDiameterIndex", "CurrentApertureDiameterIndex"
-        )
-        await send_message(
-            "CurrentApertureDiameterIndex", "CurrentApertureDiameterIndex"
-        )
+    def handle_message(
+        self, msg: memoryview, client: ExporterProtocol
+    ) -> bytes | asyncio.Future:
+        """
+        Handle a message from a client.
 
-    async def _handle_message(self, msg: str, writer: SynchronizedWriter):
-        def get_reply():
-            if msg.startswith(READ):
-                return self._handle_read(msg[len(READ) :])
+        Only the verb of the message is decoded here, the handlers decode the arguments they need.
 
-            if msg.startswith(WRTE):
-                return self._handle_write(msg[len(WRTE) :], writer)
+        Returns:
+            encoded reply to the message, or a future of the encoded reply,
+            for commands that defer their reply
+        """
+        verb = bytes(msg[:VERB_LEN])
+        handler = self._message_handlers.get(verb)
+        assert handler is not None, f"unexpected message '{bytes(msg)}'"
+        self.metrics.messages.inc(label_value=verb.decode())
 
-            if msg.startswith(EXEC):
-                return self._handle_exec(msg[len(EXEC) :])
+        # chop off the verb and the separating space
+        args = msg[VERB_LEN + 1 :]
+        reply = handler(args, client)
+        if type(reply) is str:
+            reply = encode_message(reply)
 
-            if msg.startswith(LIST):
-                return self._handle_list()
+        if self._latency is not None:
+            delay = self._latency.reply_delay(verb.decode(), _request_name(args))
+            if delay > 0:
+                return asyncio.ensure_future(self._delayed_reply(reply, delay))
 
-            if msg.startswith(NAME):
-                return "RET:MD"
+        return reply
 
-            assert False, f"unexpected message '{msg}'"
+    async def _delayed_reply(
+        self, reply: bytes | asyncio.Future, delay: float
+    ) -> bytes:
+        await asyncio.sleep(delay)
 
-        await self._write_reply(writer, get_reply())
+        if type(reply) is bytes:
+            return reply
 
-    async def new_connection(self, reader: StreamReader, writer: StreamWriter):
-        log("MD3 new connection")
+        return await reply
 
-        sync_writer = SynchronizedWriter(writer)
+    def client_connected(self, client: ExporterProtocol):
         attrs_update_callback = lambda name, attr, timestamp: self._attribute_updated(
-            sync_writer, name, attr, timestamp
+            client.events, name, attr, timestamp
         )
         self._md3.add_attribute_updated_callback(attrs_update_callback)
 
-        await self._send_initial_events(sync_writer)
+        self.write_messages(client.writer, [self._get_initial_events()], log.events)
+        events_writer = asyncio.create_task(
+            self._write_events(client.writer, client.events)
+        )
 
-        try:
-            while True:
-                msg = await self._read_message(reader)
-                await self._handle_message(msg, sync_writer)
-        except asyncio.IncompleteReadError:
-            self._md3.remove_attribute_updated_callback(attrs_update_callback)
-            log("connection closed")
-        except Exception as ex:
-            log(f"error: {str(ex)}")
-            traceback.print_exception(ex)
+        self._clients[client] = (attrs_update_callback, events_writer)
 
+    def client_disconnected(self, client: ExporterProtocol):
+        attrs_update_callback, events_writer = self._clients.pop(client)
+        self._md3.remove_attribute_updated_callback(attrs_update_callback)
+        events_writer.cancel()
+
+    def new_connection(self) -> ExporterProtocol:
+        return ExporterProtocol(self)
+
+    def new_capture(self, client: ExporterProtocol) -> Optional[CaptureWriter]:
+        """
+        Create capture file for a new client connection, if capturing is enabled.
+        """
+        if self._capture_dir is None:
+            return None
 
-exporter = Exporter()
-tcp_srv = AsyncTCPServer(PORT, exporter.new_connection)
-log("MD3 exporter emulator starting")
-tcp_srv.start()
+        capture = CaptureWriter.for_connection(self._capture_dir, client.peer)
+        log.info(f"capturing connection to {capture.path}")
+
+        return capture
+
+
+def main():
+    latency = load_latency_profile(os.environ.get("MD3_LATENCY_PROFILE"))
+    exporter = Exporter(
+        md3=MD3Up(
+            float(os.environ.get("MD3_MOTION_EVENT_RATE", MOTION_EVENT_RATE)),
+            int(os.environ.get("MD3_TASK_HISTORY_SIZE", TASK_HISTORY_SIZE)),
+            float(os.environ.get("MD3_ENCODER_SAMPLE_RATE", ENCODER_SAMPLE_RATE)),
+            latency,
+        ),
+        capture_dir=os.environ.get("MD3_CAPTURE_DIR"),
+        event_filters=load_event_filters(os.environ.get("MD3_EVENT_FILTERS")),
+        snapshot_dir=os.environ.get("MD3_SNAPSHOT_DIR"),
+        latency=latency,
+        profile_dir=os.environ.get("MD3_PROFILE_DIR"),
+    )
+    tcp_srv = AsyncTCPServer(PORT, protocol_factory=exporter.new_connection)
+    metrics_srv = MetricsServer(
+        int(os.environ.get("MD3_METRICS_PORT", METRICS_PORT)), exporter.metrics_registry
+    )
+    log.info("MD3 exporter emulator starting")
+    tcp_srv.start()
+    metrics_srv.start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Latency profiles, for emulating the timing of the real MD3Up.
+
+A profile assigns latency distributions to the emulated durations, e.g. the phase change
+time, and to the replies of commands, attribute reads and writes. The profile is loaded
+from a JSON file, e.g.
+
+    {
+        "seed": 1,
+        "durations": {
+            "phase_change": {"distribution": "lognormal", "median": 3.1, "sigma": 0.1},
+            "motor_move": {"distribution": "normal", "mean": 2.0, "stddev": 0.2}
+        },
+        "commands": {
+            "startSetPhase": {"distribution": "fixed", "value": 0.05},
+            "*": {"distribution": "fixed", "value": 0.01}
+        },
+        "reads": {"*": {"distribution": "pareto", "minimum": 0.001, "alpha": 2.5, "max": 1.0}},
+        "writes": {"OmegaPosition": {"distribution": "fixed", "value": 0.02}},
+        "reply_delay": {"distribution": "normal", "mean": 0.0005, "stddev": 0.0002}
+    }
+
+Commands, reads and writes are keyed by command and attribute names, where "*" is the
+default for names that are not listed. The reply of a request is delayed by the sum of
+the request's latency and the 'reply_delay', which emulates the network.
+"""
+
+import abc
+import math
+import json
+import random
+from typing import Optional
+from dataclasses import dataclass
+
+# names of the emulated durations
+PHASE_CHANGE = "phase_change"
+BEAMSTOP_TRAVEL = "beamstop_travel"
+MOTOR_MOVE = "motor_move"
+
+# profile sections, by the exporter protocol verb of the requests
+_VERB_SECTIONS = {"EXEC": "commands", "READ": "reads", "WRTE": "writes"}
+
+DEFAULT = "*"
+
+
+def _check(valid: bool, error_msg: str):
+    if not valid:
+        raise ValueError(error_msg)
+
+
+class Latency(abc.ABC):
+    def validate(self):
+        """
+        Raises ValueError, if the parameters are not valid for the distribution.
+        """
+
+    @abc.abstractmethod
+    def sample(self, rng: random.Random) -> float:
+        """
+        Returns a latency in seconds, never negative.
+        """
+
+
+@dataclass
+class Fixed(Latency):
+    value: float
+
+    def validate(self):
+        _check(self.value >= 0, "fixed latency value must not be negative")
+
+    def sample(self, _rng: random.Random) -> float:
+        return self.value
+
+
+@dataclass
+class Normal(Latency):
+    mean: float
+    stddev: float
+
+    def validate(self):
+        _check(self.stddev >= 0, "normal latency stddev must not be negative")
+
+    def sample(self, rng: random.Random) -> float:
+        return max(rng.gauss(self.mean, self.stddev), 0.0)
+
+
+@dataclass
+class LogNormal(Latency):
+    median: float
+    # standard deviation of the latency's natural logarithm
+    sigma: float
+
+    def validate(self):
+        _check(self.median > 0, "lognormal latency median must be positive")
+        _check(self.sigma >= 0, "lognormal latency sigma must not be negative")
+
+    def sample(self, rng: random.Random) -> float:
+        return rng.lognormvariate(math.log(self.median), self.sigma)
+
+
+@dataclass
+class Pareto(Latency):
+    """
+    Heavy tailed latency, the smaller the alpha, the heavier the tail.
+    """
+
+    minimum: float
+    alpha: float
+    # latencies are capped to this value, None for no cap
+    max: Optional[float] = None
+
+    def validate(self):
+        _check(self.minimum > 0, "pareto latency minimum must be positive")
+        _check(self.alpha > 0, "pareto latency alpha must be positive")
+        _check(
+            self.max is None or self.max >= self.minimum,
+            "pareto latency max must not be smaller than the minimum",
+        )
+
+    def sample(self, rng: random.Random) -> float:
+        latency = self.minimum * rng.paretovariate(self.alpha)
+        if self.max is not None:
+            latency = min(latency, self.max)
+
+        return latency
+
+
+# distribution name -> latency class
+DISTRIBUTIONS: dict[str, type[Latency]] = {
+    "fixed": Fixed,
+    "normal": Normal,
+    "lognormal": LogNormal,
+    "pareto": Pareto,
+}
+
+
+def parse_latency(params: dict) -> Latency:
+    """
+    Raises ValueError, on an unknown distribution or invalid parameters.
+    """
+    params = dict(params)
+    distribution = params.pop("distribution", None)
+
+    latency_class = DISTRIBUTIONS.get(distribution)
+    if latency_class is None:
+        raise ValueError(f"unknown latency distribution '{distribution}'")
+
+    try:
+        latency = latency_class(**params)
+        latency.validate()
+    except TypeError as ex:
+        # missing, unexpected or non-numeric parameters
+        raise ValueError(f"invalid {distribution} latency parameters {params}: {ex}")
+
+    return latency
+
+
+def _parse_latencies(params: dict) -> dict[str, Latency]:
+    return {name: parse_latency(latency) for name, latency in params.items()}
+
+
+class LatencyProfile:
+    def __init__(
+        self,
+        durations: dict[str, Latency],
+        requests: dict[str, dict[str, Latency]],
+        reply_delay: Optional[Latency],
+        seed: Optional[int] = None,
+    ):
+        """
+        Args:
+            durations: duration name -> latency
+            requests: exporter protocol verb -> (command or attribute name -> latency)
+            reply_delay: added to the replies of all requests
+            seed: random generator seed, for reproducible latencies
+        """
+        self._durations = durations
+        self._requests = requests
+        self._reply_delay = reply_delay
+        self._rng = random.Random(seed)
+
+    @staticmethod
+    def from_dict(params: dict) -> "LatencyProfile":
+        reply_delay = params.get("reply_delay")
+
+        return LatencyProfile(
+            _parse_latencies(params.get("durations", {})),
+            {
+                verb: _parse_latencies(params.get(section, {}))
+                for verb, section in _VERB_SECTIONS.items()
+            },
+            None if reply_delay is None else parse_latency(reply_delay),
+            params.get("seed"),
+        )
+
+    def duration(self, name: str, default: float) -> float:
+        """
+        Sample an emulated duration.
+
+        Args:
+            default: the duration, if the profile does not specify it
+        """
+        latency = self._durations.get(name)
+        if latency is None:
+            return default
+
+        return latency.sample(self._rng)
+
+    def reply_delay(self, verb: str, name: str) -> float:
+        """
+        Sample the delay of a reply to a request.
+
+        Args:
+            verb: exporter protocol verb of the request, e.g. 'EXEC'
+            name: command or attribute name of the request
+        """
+        delay = 0.0
+
+        latencies = self._requests.get(verb)
+        if latencies:
+            latency = latencies.get(name, latencies.get(DEFAULT))
+            if latency is not None:
+                delay += latency.sample(self._rng)
+
+        if self._reply_delay is not None:
+            delay += self._reply_delay.sample(self._rng)
+
+        return delay
+
+
+def load_latency_profile(path: Optional[str]) -> Optional[LatencyProfile]:
+    """
+    Load a latency profile from a JSON file, see the module documentation for the format.
+
+    The latency parameters are validated when loading, raises ValueError on invalid ones.
+    """
+    if path is None:
+        return None
+
+    with open(path) as f:
+        return LatencyProfile.from_dict(json.load(f))
@@ -0,0 +1,250 @@
+"""
+Counters, gauges and histograms, exposed over HTTP in the Prometheus text format.
+
+The metrics are updated from the exporter's event loop thread, and rendered from the HTTP
+server's thread. Values are read via snapshot copies, which are atomic under the GIL, thus
+no locking is needed on the hot paths.
+"""
+
+import abc
+import asyncio
+from bisect import bisect_left
+from typing import Optional
+from dataclasses import dataclass
+from collections.abc import Callable
+from atcpserv import AsyncTCPServer
+
+# histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _format_sample(
+    name: str, label: Optional[str], label_value: Optional[str], value: float
+) -> str:
+    if label is None or label_value is None:
+        return f"{name} {value}"
+
+    return f'{name}{{{label}="{label_value}"}} {value}'
+
+
+class Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None):
+        """
+        Args:
+            label: name of the metric's label, if it have one
+        """
+        self.name = name
+        self.help = help
+        self.label = label
+
+    @abc.abstractmethod
+    def _samples(self):
+        """
+        Yields the metric's sample lines.
+        """
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None):
+        super().__init__(name, help, label)
+        # label value -> count
+        self._values: dict[Optional[str], float] = {}
+
+    def inc(self, amount: float = 1, label_value: Optional[str] = None):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def _samples(self):
+        for label_value, value in list(self._values.items()):
+            yield _format_sample(self.name, self.label, label_value, value)
+
+
+class Gauge(Metric):
+    """
+    A gauge, which value is read when metrics are rendered.
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        read_value: Callable[[], float | dict[str, float]],
+        label: Optional[str] = None,
+    ):
+        """
+        Args:
+            read_value: returns the gauge's value, or a label value -> value dictionary
+        """
+        super().__init__(name, help, label)
+        self._read_value = read_value
+
+    def _samples(self):
+        value = self._read_value()
+        if not isinstance(value, dict):
+            yield _format_sample(self.name, None, None, value)
+            return
+
+        for label_value, val in value.items():
+            yield _format_sample(self.name, self.label, label_value, val)
+
+
+@dataclass
+class HistogramSeries:
+    # per bucket counts, the last count is for the +Inf bucket
+    counts: list[int]
+    # sum of all observed values
+    sum: float = 0.0
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label: Optional[str] = None,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, label)
+        self._buckets = buckets
+        self._series: dict[Optional[str], HistogramSeries] = {}
+
+    def observe(self, value: float, label_value: Optional[str] = None):
+        series = self._series.get(label_value)
+        if series is None:
+            series = HistogramSeries([0] * (len(self._buckets) + 1))
+            self._series[label_value] = series
+
+        # index of the first bucket with upper bound >= value, or of the +Inf bucket
+        series.counts[bisect_left(self._buckets, value)] += 1
+        series.sum += value
+
+    def _samples(self):
+        def bucket_label(bound):
+            le = f'le="{bound}"'
+            if label_value is None:
+                return le
+            return f'{self.label}="{label_value}",{le}'
+
+        def labels():
+            if label_value is None:
+                return ""
+            return f'{{{self.label}="{label_value}"}}'
+
+        for label_value, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self._buckets + ("+Inf",), list(series.counts)):
+                cumulative += count
+                yield f"{self.name}_bucket{{{bucket_label(bound)}}} {cumulative}"
+
+            yield f"{self.name}_sum{labels()} {series.sum}"
+            yield f"{self.name}_count{labels()} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[Metric] = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, label: Optional[str] = None) -> Counter:
+        return self._add(Counter(name, help, label))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        read_value: Callable[[], float | dict[str, float]],
+        label: Optional[str] = None,
+    ) -> Gauge:
+        return self._add(Gauge(name, help, read_value, label))
+
+    def histogram(self, name: str, help: str, label: Optional[str] = None) -> Histogram:
+        return self._add(Histogram(name, help, label))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves the metrics over HTTP, on the '/metrics' path.
+    """
+
+    def __init__(self, port: int, registry: Registry):
+        self._registry = registry
+        self._tcp_srv = AsyncTCPServer(port, self._handle_request)
+
+    def start(self):
+        self._tcp_srv.start()
+
+    def stop(self):
+        self._tcp_srv.stop()
+
+    def _response(self, request_line: bytes) -> bytes:
+        method, path, *_ = request_line.decode().split(" ")
+        if method != "GET" or path.split("?")[0] != "/metrics":
+            status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+        else:
+            status, content_type, body = "200 OK", CONTENT_TYPE, self._registry.render()
+
+        body = body.encode()
+        header = (
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        )
+
+        return header.encode() + body
+
+    async def _handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            request_line = await reader.readline()
+
+            # skip the request headers
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+
+            writer.write(self._response(request_line))
+            await writer.drain()
+        except (ValueError, ConnectionError):
+            # malformed request, or client gone
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,198 @@
+"""
+Motion engine, that models motor moves as time based trajectories.
+
+Each active move is a trajectory in the engine's table, defined by its start and end
+positions and times. The current position of a moving motor is computed from the
+monotonic clock, whenever it is needed, thus it is exact regardless of the event rate.
+
+Position events are an independent sampling of the trajectories. All trajectories
+are sampled together, at a fixed rate, and the samples of one tick are sent to clients
+as one batch of events. When a trajectory ends, its final position is reported
+at the exact end time.
+
+The engine uses a single timer, that is only armed while some motor is moving, so the CPU
+and timer use depends on the sampling rate, rather than on the number of moving motors.
+"""
+
+import math
+import asyncio
+from time import monotonic
+from typing import Optional
+from dataclasses import dataclass
+from collections.abc import Callable, Hashable
+
+
+@dataclass
+class Trajectory:
+    start_pos: float
+    end_pos: float
+    # times are in monotonic clock seconds
+    start_time: float
+    end_time: float
+    # positions are wrapped modulo this value, for rotation axes
+    wrap: Optional[float]
+    # resolved when the move is finished
+    done: asyncio.Future
+
+    def position(self, now: float) -> float:
+        if now >= self.end_time:
+            pos = self.end_pos
+        else:
+            progress = (now - self.start_time) / (self.end_time - self.start_time)
+            pos = self.start_pos + progress * (self.end_pos - self.start_pos)
+
+        if self.wrap is not None:
+            pos %= self.wrap
+
+        return pos
+
+
+def _resolve(done: asyncio.Future):
+    # the future is cancelled, if the coroutine awaiting it was cancelled
+    if not done.done():
+        done.set_result(None)
+
+
+class MotionEngine:
+    def __init__(
+        self,
+        sample_interval: Optional[float],
+        position_updated: Callable[[Hashable, float], None],
+        motion_finished: Callable[[Hashable], None],
+    ):
+        """
+        Motors are identified by keys, e.g. motor names, which are passed to the callbacks.
+
+        Args:
+            sample_interval: time between position samples, in seconds,
+                             None for only reporting the final positions
+            position_updated: called with motor key and sampled position
+            motion_finished: called with motor key, after the final position is reported
+        """
+        self._sample_interval = sample_interval
+        self._position_updated = position_updated
+        self._motion_finished = motion_finished
+
+        # motor key -> active trajectory
+        self._trajectories: dict[Hashable, Trajectory] = {}
+        self._next_sample = math.inf
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def move(
+        self,
+        motor: Hashable,
+        start_pos: float,
+        end_pos: float,
+        duration: float,
+        wrap: Optional[float] = None,
+    ) -> asyncio.Future:
+        """
+        Start moving the motor. A move of an already moving motor, replaces its trajectory.
+
+        Args:
+            wrap: for rotation axes, the positions are wrapped modulo this value,
+                  while the end position may be outside of the wrapped range,
+                  e.g. from 350 to 370 moves through 360
+
+        Returns:
+            future, which is resolved when the move is finished, replaced or stopped
+        """
+        now = monotonic()
+
+        superseded = self._trajectories.pop(motor, None)
+        if superseded is not None:
+            _resolve(superseded.done)
+
+        if not self._trajectories and self._sample_interval is not None:
+            # start sampling
+            self._next_sample = now + self._sample_interval
+
+        trajectory = Trajectory(
+            start_pos,
+            end_pos,
+            now,
+            now + max(duration, 0.0),
+            wrap,
+            asyncio.get_running_loop().create_future(),
+        )
+        self._trajectories[motor] = trajectory
+        self._schedule()
+
+        return trajectory.done
+
+    def stop_all(self) -> dict[Hashable, float]:
+        """
+        Stop all moves immediately, without reporting positions.
+
+        Returns:
+            motor key -> position, where the motor was stopped
+        """
+        now = monotonic()
+        trajectories = self._trajectories
+        self._trajectories = {}
+        self._schedule()
+
+        for trajectory in trajectories.values():
+            _resolve(trajectory.done)
+
+        return {
+            motor: trajectory.position(now)
+            for motor, trajectory in trajectories.items()
+        }
+
+    def position(self, motor: Hashable) -> Optional[float]:
+        """
+        Get the current position of a moving motor.
+
+        Returns:
+            the position, or None if the motor is not moving
+        """
+        trajectory = self._trajectories.get(motor)
+        if trajectory is None:
+            return None
+
+        return trajectory.position(monotonic())
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._trajectories:
+            self._next_sample = math.inf
+            return
+
+        end_time = min(
+            trajectory.end_time for trajectory in self._trajectories.values()
+        )
+        wakeup = min(self._next_sample, end_time)
+        self._timer = asyncio.get_running_loop().call_later(
+            max(wakeup - monotonic(), 0.0), self._tick
+        )
+
+    def _tick(self):
+        self._timer = None
+        now = monotonic()
+
+        try:
+            if now >= self._next_sample:
+                for motor, trajectory in list(self._trajectories.items()):
+                    if now < trajectory.end_time:
+                        self._position_updated(motor, trajectory.position(now))
+
+                # samples are at fixed intervals, missed samples are skipped
+                missed = int((now - self._next_sample) / self._sample_interval)
+                self._next_sample += (missed + 1) * self._sample_interval
+
+            finished = [
+                motor
+                for motor, trajectory in self._trajectories.items()
+                if now >= trajectory.end_time
+            ]
+            for motor in finished:
+                trajectory = self._trajectories.pop(motor)
+                self._position_updated(motor, trajectory.position(now))
+                self._motion_finished(motor)
+                _resolve(trajectory.done)
+        finally:
+            self._schedule()
@@ -0,0 +1,140 @@
+"""
+Runtime-togglable profiling of the exporter's request handling.
+
+When enabled, the profiler times command executions, attribute writes and attribute
+update callback fan-outs, and keeps the slowest invocations, with their arguments.
+It also runs cProfile on the exporter's event loop thread, so that pstats files
+can be dumped on demand.
+
+Check the 'enabled' flag before calling into the profiler, so that disabled profiling
+costs nothing on the hot paths:
+
+    if profiler.enabled:
+        return profiler.call(COMMAND, name, args, func, *args)
+"""
+
+import os
+import heapq
+import pstats
+import cProfile
+import itertools
+from time import perf_counter
+from typing import Any, Optional
+from dataclasses import dataclass, field
+from collections.abc import Callable
+
+# number of slowest invocations to keep
+DEFAULT_TOP_N = 20
+
+# profiled invocation kinds
+COMMAND = "exec"  # MD3Up.exec_command() dispatches
+WRITE = "write"  # attribute writes requested by clients
+CALLBACKS = "callbacks"  # attribute update callbacks fan-outs
+
+
+@dataclass(order=True)
+class Invocation:
+    duration: float
+    # breaks ties between equally slow invocations
+    sequence: int
+    kind: str = field(compare=False)
+    name: str = field(compare=False)
+    args: Any = field(compare=False)
+
+    def __str__(self):
+        return f"{self.duration * 1000:.3f} ms {self.kind} {self.name} {self.args}"
+
+
+class Profiler:
+    def __init__(self, top_n: int = DEFAULT_TOP_N):
+        self.enabled = False
+        self._top_n = top_n
+        # min-heap of the slowest invocations
+        self._slowest: list[Invocation] = []
+        self._sequence = itertools.count()
+        self._cprofile: Optional[cProfile.Profile] = None
+        self._cprofile_running = False
+
+    @staticmethod
+    def from_env() -> "Profiler":
+        """
+        Create profiler, configured by MD3_PROFILE and MD3_PROFILE_TOP_N environment variables.
+        """
+        profiler = Profiler(int(os.environ.get("MD3_PROFILE_TOP_N", DEFAULT_TOP_N)))
+        if os.environ.get("MD3_PROFILE", "").lower() in ("1", "true", "yes"):
+            profiler.enable()
+
+        return profiler
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self._stop_cprofile()
+
+    def reset(self):
+        """
+        Forget the recorded invocations and the cProfile statistics.
+        """
+        self._slowest.clear()
+        self._stop_cprofile()
+        self._cprofile = None
+
+    def _start_cprofile(self):
+        # cProfile profiles the thread it is enabled from, thus it is started
+        # lazily from the profiled code, rather than from enable()
+        if self._cprofile is None:
+            self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+        self._cprofile_running = True
+
+    def _stop_cprofile(self):
+        if self._cprofile_running:
+            self._cprofile.disable()
+            self._cprofile_running = False
+
+    def _record(self, kind: str, name: str, args: Any, duration: float):
+        slowest = self._slowest
+        if len(slowest) >= self._top_n and duration <= slowest[0].duration:
+            return
+
+        invocation = Invocation(duration, next(self._sequence), kind, name, args)
+        if len(slowest) < self._top_n:
+            heapq.heappush(slowest, invocation)
+        else:
+            heapq.heapreplace(slowest, invocation)
+
+    def call(self, kind: str, name: str, args: Any, func: Callable, *func_args):
+        """
+        Call the function, and record the invocation if it is one of the slowest.
+
+        Args:
+            name: name of the command or attribute, that the function handles
+            args: arguments to record, if the invocation is one of the slowest
+        """
+        if not self._cprofile_running:
+            self._start_cprofile()
+
+        start = perf_counter()
+        try:
+            return func(*func_args)
+        finally:
+            self._record(kind, name, args, perf_counter() - start)
+
+    def slowest(self) -> list[Invocation]:
+        """
+        Get the slowest recorded invocations, the slowest first.
+        """
+        return sorted(self._slowest, reverse=True)
+
+    def dump_stats(self, path: str):
+        """
+        Write the cProfile statistics, collected so far, to a pstats file.
+        """
+        if self._cprofile is None:
+            raise ValueError("no profiling statistics collected")
+
+        # creating the stats disables the profiler, it is restarted on the next profiled call
+        self._cprofile_running = False
+        pstats.Stats(self._cprofile).dump_stats(path)
@@ -0,0 +1,57 @@
+"""
+Planning of raster scans.
+
+A raster scan is a grid of frames, centered at the current position of the scanned motors.
+The grid is scanned line by line, each line moves the vertical motor over the vertical
+range, while the frames of the line are taken. Between the lines, the horizontal motor
+steps to the next line. With reverse direction enabled, every other line is scanned
+downwards, i.e. the scan follows a serpentine path.
+"""
+
+import numpy
+from dataclasses import dataclass
+
+
+@dataclass
+class RasterPlan:
+    # per line positions, one element per line
+    horizontal: numpy.ndarray
+    vertical_start: numpy.ndarray
+    vertical_end: numpy.ndarray
+
+    def __len__(self):
+        return len(self.horizontal)
+
+
+def plan_raster_scan(
+    vertical_center: float,
+    horizontal_center: float,
+    vertical_range: float,
+    horizontal_range: float,
+    num_lines: int,
+    reverse_direction: bool,
+) -> RasterPlan:
+    """
+    Compute the positions of all the lines of a raster scan.
+
+    Args:
+        num_lines: number of lines, the lines are spread over the horizontal range
+        reverse_direction: scan every other line in the reverse direction
+    """
+    lines = numpy.arange(num_lines)
+
+    if num_lines > 1:
+        horizontal_step = horizontal_range / (num_lines - 1)
+        horizontal = horizontal_center - horizontal_range / 2 + lines * horizontal_step
+    else:
+        horizontal = numpy.full(num_lines, horizontal_center)
+
+    vertical_start = numpy.full(num_lines, vertical_center - vertical_range / 2)
+    vertical_end = numpy.full(num_lines, vertical_center + vertical_range / 2)
+
+    if reverse_direction:
+        # swap the ends of every other line
+        odd = lines % 2 == 1
+        vertical_start[odd], vertical_end[odd] = vertical_end[odd], vertical_start[odd]
+
+    return RasterPlan(horizontal, vertical_start, vertical_end)